@@ -1,16 +1,23 @@
+import os
+import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import optim
 from functools import partial
+from operator import attrgetter
 import fastcore.all as fc
 
-from .callbacks.callbacks import run_callbacks
+from .callbacks.callbacks import get_callback_methods
+from .callbacks.checkpoint import get_rng_state, load_checkpoint, restore_learner, set_rng_state
+from .callbacks.utils import rebuild_dataloader
 from .exceptions import (
     CancelBatchException,
     CancelEpochException,
     CancelFitException
 )
 
+__all__ = ['with_cbs', 'Learner', 'TrainLearner', 'CancelBatchException', 'CancelEpochException', 'CancelFitException']
+
 
 class with_cbs:
     '''
@@ -20,21 +27,27 @@ class with_cbs:
 
     def __init__(self, loop_point):
         self.loop_point = loop_point
+        # event names and loop point exception are resolved once, at decoration time
+        self.before = f'before_{loop_point}'
+        self.after = f'after_{loop_point}'
+        self.cleanup = f'cleanup_{loop_point}'
+        self.exception = globals()[f'Cancel{loop_point.title()}Exception']
 
     def __call__(self, f):
+        before, after, cleanup, exception = self.before, self.after, self.cleanup, self.exception
+
         def fun(obj, *args, **kwargs):
             try:
                 # exec before point callback
-                obj.callback(f'before_{self.loop_point}')
+                obj.callback(before)
                 f(obj, *args, **kwargs)  # exec decorated function
                 # exec after point callback
-                obj.callback(f'after_{self.loop_point}')
-            # loop point execption in globals program variables..
-            except globals()[f'Cancel{self.loop_point.title()}Exception']:
+                obj.callback(after)
+            except exception:
                 pass
             finally:
                 # exec cleanup point callback
-                obj.callback(f'cleanup_{self.loop_point}')
+                obj.callback(cleanup)
         return fun
 
 
@@ -43,39 +56,176 @@ class Learner():
     flexible learner
     '''
 
-    def __init__(self, model, dataloaders=(0,), loss_func=F.cross_entropy, lr=0.1, callbacks=None, opt_func=optim.SGD):
+    def __init__(self, model, dataloaders=(0,), loss_func=F.cross_entropy, lr=0.1, callbacks=None, opt_func=optim.SGD,
+                 grad_accum=1, accum_partial=True, keep_opt=False, opt_kwargs=None, splitter=None):
+        '''
+        grad_accum: number of micro batches whose gradients are accumulated before every optimizer step,
+        the loss is divided by it before backward.
+        accum_partial: at the end of the epoch, step with the gradients of the last incomplete accumulation,
+        otherwise they are discarded.
+        keep_opt: reuse the optimizer, and its state (momentum, Adam moments), across successive fit calls.
+        Only the lr is setted by fit. Use reset_opt() to rebuild it.
+        opt_kwargs: other opt_func arguments, like foreach=True or fused=True to choose the optimizer implementation,
+        or weight_decay.
+        splitter: function returning the param groups of the model (a list of lists of parameters, or of dicts
+        with their own options, like lr), passed to opt_func in place of model.parameters().
+        '''
         callbacks = fc.L(callbacks)
         fc.store_attr()
+        self.opt = None
+        self.resume = None
+        self.profiler = None  # setted by ProfilerCB
         self.callback = self._callback  # Assign the method here
         self.callback('after_init')
 
+    @property
+    def callbacks(self):
+        return self._callbacks
+
+    @callbacks.setter
+    def callbacks(self, callbacks):
+        self._callbacks = callbacks
+        self.reset_dispatch()
+
+    def reset_dispatch(self):
+        '''
+        clears the cached event dispatch table.
+        fit calls it at its start, it's needed only after changing self.callbacks in place during a fit
+        '''
+        self._dispatch = {}
+
+    def _accum_size(self):
+        # number of micro batches of the current accumulation
+        n = self.grad_accum
+        if self.accum_partial and self.n_iter is not None:
+            n = min(n, self.n_iter - (self.iter - self.iter % n))
+        return n
+
+    def _accum_done(self):
+        return (self.iter + 1) % self.grad_accum == 0 or (self.accum_partial and self.iter + 1 == self.n_iter)
+
+    def _opt_params(self):
+        return self.model.parameters() if self.splitter is None else self.splitter(self.model)
+
+    def create_opt(self, lr=None):
+        '''
+        builds self.opt with opt_func on the param groups of splitter, with the opt_kwargs arguments
+        '''
+        self.opt = self.opt_func(self._opt_params(), self.lr if lr is None else lr, **(self.opt_kwargs or {}))
+        self.opt_lrs = [pg['lr'] for pg in self.opt.param_groups]  # lrs restored by fit when it reuses the optimizer
+        return self.opt
+
+    def reset_opt(self):
+        '''
+        discards the optimizer and its state, the next fit builds a new one
+        (after changing the model parameters or the splitter)
+        '''
+        self.opt = None
+
+    def set_lr(self, lr):
+        '''
+        sets the lr of the optimizer, lr is a number for all the param groups or a list with one lr for each group
+        '''
+        lrs = list(lr) if isinstance(lr, (list, tuple)) else [lr] * len(self.opt.param_groups)
+        for pg, lr in zip(self.opt.param_groups, lrs):
+            pg['lr'] = lr
+            if 'initial_lr' in pg:
+                pg['initial_lr'] = lr  # setted by the schedulers of previous fits, the new ones start from it
+        self.opt_lrs = lrs
+
+    def _same_params(self):
+        params = list(self._opt_params())
+        if params and isinstance(params[0], dict):
+            params = [p for g in params for p in g['params']]
+        elif params and not isinstance(params[0], torch.Tensor):
+            params = [p for g in params for p in g]
+        return [id(p) for p in params] == [id(p) for g in self.opt.param_groups for p in g['params']]
+
     @with_cbs('batch')
     def _one_batch(self):
+        self.stepped = False  # True when the optimizer steps, so step based callbacks can follow it
         self.predict()
         self.callback('after_predict')
         self.get_loss()
         self.callback('after_loss')
         if self.training:
-            self.backward()
+            if self.grad_accum > 1:
+                loss, self.loss = self.loss, self.loss / self._accum_size()
+                self.backward()
+                self.loss = loss
+            else:
+                self.backward()
             self.callback('after_backward')
-            self.step()
-            self.callback('after_step')
-            self.zero_grad()
+            if self.grad_accum == 1 or self._accum_done():
+                self.step()
+                self.callback('after_step')
+                self.zero_grad()
+                self.stepped = True
 
     @with_cbs('epoch')
     def _one_epoch(self):
+        self.stepped = False
+        try:
+            self.n_iter = len(self.dl)
+        except TypeError:
+            self.n_iter = None
         for self.iter, self.batch in enumerate(self.dl):
+            if self.resume is not None and self.training:
+                if self.iter < self.resume['iter']:
+                    continue  # batches consumed before the checkpoint
+                self._resumed()
             self._one_batch()
+        if self.resume is not None and self.training:
+            self._resumed()
+        if self.training and self.grad_accum > 1 and not self.stepped:
+            # gradients of an incomplete accumulation, dataloader without len
+            if self.accum_partial:
+                self.step()
+                self.callback('after_step')
+            self.zero_grad()
+
+    def _resumed(self):
+        # the rng state of the checkpoint replaces the one of the epoch start, used to replay the shuffling
+        set_rng_state(self.resume['rng'])
+        self.resume = None
+
+    def _pending_validation(self):
+        # the checkpoint was saved at the end of a training epoch, before its validation ran
+        set_rng_state(self.resume['rng'])
+        torch.no_grad()(self.one_epoch)(False)
+        self.resume['rng'] = self.resume['epoch_rng'] = get_rng_state()  # the next epoch starts after the validation
 
     def one_epoch(self, training):
         self.model.train(training)
         self.dl = self.dataloaders.train if training else self.dataloaders.valid
+        if training and self.resume is not None:
+            set_rng_state(self.resume['epoch_rng'])
         self._one_epoch()
 
+    def validate(self):
+        '''
+        Runs a validation epoch in the middle of a training epoch (IntervalValidationCB),
+        then restores the state of the training loop (dl, iter, batch, preds, loss).
+        '''
+        state = {k: getattr(self, k) for k in ('dl', 'iter', 'batch', 'preds', 'loss', 'n_iter', 'stepped')
+                 if k in self.__dict__}
+        training = self.model.training
+        try:
+            torch.no_grad()(self.one_epoch)(False)
+        finally:
+            self.__dict__.update(state)
+            self.model.train(training)
+
     @with_cbs('fit')
     def _fit(self, train, valid):
+        if self.resume is not None:
+            restore_learner(self, self.resume)
         # training loop
         for self.epoch in self.epochs:
+            if self.resume is not None and self.epoch < self.resume['epoch']:
+                if valid and self.resume.get('valid_pending') and self.epoch == self.resume['epoch'] - 1:
+                    self._pending_validation()
+                continue
             if train:
                 self.one_epoch(True)
             if valid:
@@ -91,7 +241,7 @@ class Learner():
     and append some callbacks to the callbacks learner list
     '''
 
-    def fit(self, n_epochs=1, train=True, valid=True, callbacks=None, lr=None):
+    def fit(self, n_epochs=1, train=True, valid=True, callbacks=None, lr=None, resume=None):
         '''
         Fit the model for a specified number of epochs.
 
@@ -101,6 +251,10 @@ class Learner():
         - valid (bool): If True, perform validation (default: True)
         - callbacks (list): Additional callbacks to use during training (default: None)
         - lr (float): Learning rate. If None, uses the lr specified during initialization (default: None)
+          With keep_opt the reused optimizer gets this lr (or a list with one lr for each param group),
+          if None the lrs it was built with
+        - resume (str): checkpoint file (or CheckpointCB directory, for the latest one) to resume from,
+          at the exact epoch and training batch where it was saved (default: None)
 
         Behavior:
         - If train=True and valid=True: Performs both training and validation for each epoch
@@ -114,17 +268,132 @@ class Learner():
 
         for callback in callbacks:
             self.callbacks.append(callback)
+        # rebuilt once per fit, so callbacks added to self.callbacks in place since the last fit are dispatched
+        self.reset_dispatch()
         try:
             self.n_epochs = n_epochs
             self.epochs = range(n_epochs)
-            if lr is None:
-                lr = self.lr
             if self.opt_func:
-                self.opt = self.opt_func(self.model.parameters(), lr)
+                if self.keep_opt and self.opt is not None and self._same_params():
+                    self.set_lr(self.opt_lrs if lr is None else lr)
+                else:
+                    self.create_opt(lr)
+            self.resume = load_checkpoint(resume) if resume is not None else None
             self._fit(train, valid)
         finally:
+            self.resume = None
             for callback in callbacks:
                 self.callbacks.remove(callback)
+            if callbacks:
+                self.reset_dispatch()
+
+    def _inference_dl(self, dl, batch_size):
+        dl = self.dataloaders.valid if dl is None else dl
+        if batch_size is not None:
+            dl = rebuild_dataloader(dl, batch_size=batch_size, shuffle=False)
+        return dl
+
+    def predict_stream(self, dl=None, batch_size=None, n_inp=1, with_targets=False):
+        '''
+        Yields the model predictions batch by batch, under torch.inference_mode and without the training loop.
+        The batches go through the transforms of the callbacks exposing transform_batch (DeviceCB, BatchTransformCB).
+
+        Parameters:
+        - dl (DataLoader): dataloader to predict (default: dataloaders.valid)
+        - batch_size (int): if setted, dl is rebuilt with this batch size, it can be larger than the training one (default: None)
+        - n_inp (int): number of model inputs in the batch (default: 1)
+        - with_targets (bool): yields (predictions, targets) tuples (default: False)
+        '''
+        dl = self._inference_dl(dl, batch_size)
+        cbs = [cb for cb in sorted(self.callbacks, key=attrgetter('order')) if hasattr(cb, 'transform_batch')]
+        for cb in cbs:
+            if getattr(cb, 'device', None) is not None:
+                self.model.to(cb.device)
+        training = self.model.training
+        self.model.eval()
+        try:
+            for batch in dl:
+                # inference mode can't be left enabled while the generator is suspended
+                with torch.inference_mode():
+                    for cb in cbs:
+                        batch = cb.transform_batch(batch, False)
+                    preds = self.model(*batch[:n_inp])
+                yield (preds, batch[n_inp]) if with_targets else preds
+        finally:
+            self.model.train(training)
+
+    def get_preds(self, dl=None, batch_size=None, n_inp=1, out=None, out_path=None):
+        '''
+        Predictions of the model over a dataloader, written batch by batch into a preallocated output,
+        so only one batch of predictions is in memory at a time besides the output.
+
+        Parameters:
+        - dl, batch_size, n_inp: see predict_stream
+        - out (Tensor): preallocated tensor where the predictions are written (default: None)
+        - out_path (str): .npy file, memory mapped, where the predictions are written (default: None)
+
+        Without out and out_path, a cpu tensor is allocated after the first batch.
+        When the length of the dataset isn't known (IterableDataset), the predictions are gathered in memory,
+        or with out_path appended to a raw file copied into the .npy at the end.
+        Returns the filled part of the output
+        '''
+        dl = self._inference_dl(dl, batch_size)
+        try:
+            n = len(dl.dataset) if hasattr(dl, 'dataset') else None
+        except TypeError:  # IterableDataset
+            n = None
+        res, chunks, i, part = out, [], 0, None
+        for preds in self.predict_stream(dl, n_inp=n_inp):
+            if preds.dtype == torch.bfloat16:
+                preds = preds.float()
+            if res is None and n is not None:
+                shape = (n, *preds.shape[1:])
+                if out_path is not None:
+                    res = np.lib.format.open_memmap(out_path, mode='w+', dtype=preds.cpu().numpy().dtype, shape=shape)
+                else:
+                    res = torch.empty(shape, dtype=preds.dtype)
+            if res is None:  # dataset without len
+                if out_path is None:
+                    chunks.append(preds.cpu())
+                    continue
+                if part is None:
+                    part, part_shape = open(out_path + '.part', 'wb'), (preds.shape[1:], preds.cpu().numpy().dtype)
+                part.write(preds.cpu().numpy().tobytes())
+                i += len(preds)
+                continue
+            res[i:i+len(preds)] = preds.cpu().numpy() if isinstance(res, np.ndarray) else preds
+            i += len(preds)
+        if part is not None:
+            part.close()
+            (shape, dtype), raw = part_shape, out_path + '.part'
+            res = np.lib.format.open_memmap(out_path, mode='w+', dtype=dtype, shape=(i, *shape))
+            src = np.memmap(raw, dtype=dtype, mode='r', shape=(i, *shape))
+            step = max(1, 2**26 // max(1, src[:1].nbytes))  # copied in chunks of about 64MB
+            for j in range(0, i, step):
+                res[j:j+step] = src[j:j+step]
+            del src
+            os.remove(raw)
+        if res is None:
+            return torch.cat(chunks) if chunks else None
+        if isinstance(res, np.memmap):
+            res.flush()
+        return res[:i]
+
+    def autotune(self, **kwargs):
+        '''
+        Finds (and with apply=True sets) the batch size, DataLoader workers and threads
+        with the best training throughput, see autotune.autotune for the arguments.
+        '''
+        from .autotune import autotune
+        return autotune(self, **kwargs)
+
+    def quantize(self, **kwargs):
+        '''
+        int8 copy of the trained model for cpu inference (dynamic or static quantization),
+        compared with the fp32 model on validation metrics and speed, see quantization.quantize for the arguments.
+        '''
+        from .quantization import quantize
+        return quantize(self, **kwargs)
 
     def __getattr__(self, name):
         if name in ('predict', 'get_loss', 'backward', 'step', 'zero_grad'):
@@ -132,7 +401,16 @@ class Learner():
         raise AttributeError(name)
 
     def _callback(self, method_name):
-        run_callbacks(self.callbacks, method_name, self)
+        # event name -> ordered list of bound methods, built on first use
+        try:
+            methods = self._dispatch[method_name]
+        except KeyError:
+            methods = self._dispatch[method_name] = get_callback_methods(self.callbacks, method_name)
+        if self.profiler is not None and self.profiler.active:
+            self.profiler.run(self, method_name, methods)
+            return
+        for method in methods:
+            method(self)
 
     @property
     def training(self):
@@ -1 +1,6 @@
 from .Learner import *
+from .ensemble import *
+from .autotune import *
+from .sweep import *
+from .data import *
+from .quantization import *
@@ -0,0 +1,245 @@
+'''
+Throughput autotuning of batch size, DataLoader workers and threads, with short timed training runs.
+
+example usage:
+best = learn.autotune(batch_sizes=[64, 128, 256, 512], apply=True)
+'''
+import os
+import time
+from contextlib import contextmanager
+from copy import copy
+import torch
+
+from .callbacks.callbacks import Callback, TrainCB
+from .callbacks.checkpoint import learner_state, restore_learner, set_rng_state
+from .callbacks.device import DeviceCB
+from .callbacks.prefetch import PrefetchCB
+from .callbacks.utilities import AccelerateCB, MixedPrecisionCB
+from .callbacks.utils import rebuild_dataloader
+from .exceptions import CancelFitException
+
+# autotune() isn't exported, so `from AIFramework import *` doesn't shadow this module,
+# use learn.autotune or `from AIFramework.autotune import autotune`
+__all__ = ['bare_callbacks', 'isolated_fit', 'TimingCB']
+
+
+class _TransformCB(Callback):
+    ''' applies the transform_batch of cb in before_batch, without the other events of cb (stats, caches,..) '''
+    prefetched = False  # setted by PrefetchCB
+
+    def __init__(self, cb):
+        self.cb, self.order = cb, cb.order
+
+    def transform_batch(self, batch, training):
+        return self.cb.transform_batch(batch, training)
+
+    def before_batch(self, learn):
+        if not self.prefetched:
+            learn.batch = self.transform_batch(learn.batch, learn.training)
+
+
+def bare_callbacks(learn, device=None, amp=True, prefetch=True):
+    """copies of the callbacks of the learner needed to run its batches: DeviceCB, PrefetchCB,
+    the batch transforms (their transform_batch only) and the train callback.
+    AccelerateCB is replaced by a TrainCB, so the model and the dataloaders aren't prepared.
+    Recorder, metrics, schedulers, checkpoints, logs,.. are left out.
+
+    Args:
+        learn (Learner): the learner
+        device (str, optional): device of the DeviceCB copies. Defaults to None (unchanged).
+        amp (bool, optional): keep MixedPrecisionCB, otherwise it's replaced by a TrainCB. Defaults to True.
+        prefetch (bool, optional): keep PrefetchCB. Defaults to True.
+
+    Returns:
+        list: the callbacks
+    """
+    cbs = []
+    for cb in learn.callbacks:
+        if isinstance(cb, DeviceCB):
+            cb = copy(cb)
+            cb.device = cb.device if device is None else device
+        elif isinstance(cb, PrefetchCB):
+            if not prefetch:
+                continue
+            cb = copy(cb)
+        elif hasattr(cb, 'transform_batch'):
+            cb = _TransformCB(cb)
+        elif isinstance(cb, AccelerateCB) or (isinstance(cb, MixedPrecisionCB) and not amp):
+            cb = TrainCB(cb.n_inp)
+        elif isinstance(cb, TrainCB):
+            cb = copy(cb)
+        else:
+            continue
+        cbs.append(cb)
+    return cbs
+
+
+@contextmanager
+def isolated_fit(learn, callbacks):
+    """the fits inside run with callbacks only, in place of the callbacks of the learner.
+    On exit all the attributes of the learner (callbacks, opt, scheduler, scaler, metrics, recorder,..)
+    are the ones before, the callbacks of the learner aren't run so their state isn't changed.
+    The model and the dataloaders are the same objects, changed in place by training.
+
+    example usage:
+    with isolated_fit(learn, bare_callbacks(learn)):
+        learn.fit(1, valid=False)
+    """
+    state = dict(learn.__dict__)
+    learn.callbacks = list(callbacks)
+    try:
+        yield learn
+    finally:
+        learn.__dict__.clear()
+        learn.__dict__.update(state)
+        learn.reset_dispatch()
+
+
+def _sync(learn):
+    param = next(learn.model.parameters(), None)
+    if param is not None and param.is_cuda:
+        torch.cuda.synchronize(param.device)
+
+
+def _is_oom(e):
+    return isinstance(e, (torch.cuda.OutOfMemoryError, MemoryError)) or \
+        isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+
+class TimingCB(Callback):
+    ''' times n_batches training batches, after n_warmup ones, then cancels the fit '''
+    order = 1000  # the whole batch is timed
+
+    def __init__(self, n_batches=5, n_warmup=2):
+        self.n_batches, self.n_warmup = n_batches, n_warmup
+
+    def before_fit(self, learn):
+        self.count, self.samples, self.start, self.elapsed = 0, 0, None, None
+
+    def before_batch(self, learn):
+        if self.count == self.n_warmup:
+            _sync(learn)
+            self.start = time.perf_counter()
+
+    def after_batch(self, learn):
+        self.count += 1
+        if self.count > self.n_warmup:
+            self.samples += len(learn.batch[0])
+        if self.count == self.n_warmup + self.n_batches:
+            _sync(learn)
+            self.elapsed = time.perf_counter() - self.start
+            raise CancelFitException()
+
+
+def _trial(learn, batch_size, num_workers, threads, n_batches, n_warmup):
+    dls = learn.dataloaders
+    train = dls.train
+    timing = TimingCB(n_batches, n_warmup)
+    res = {'batch_size': batch_size, 'num_workers': num_workers, 'threads': threads}
+    try:
+        dls.train = rebuild_dataloader(train, batch_size=batch_size, num_workers=num_workers)
+        torch.set_num_threads(threads)
+        learn.fit(1, valid=False, callbacks=[timing])
+    except Exception as e:
+        if not _is_oom(e):
+            raise
+        res['oom'] = True
+    finally:
+        dls.train = train
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    if timing.elapsed is None:
+        res.setdefault('oom', False)  # not enough batches in the dataloader
+        return res
+    res.update(samples_per_sec=timing.samples / timing.elapsed, ms_per_batch=timing.elapsed * 1000 / n_batches)
+    return res
+
+
+def autotune(learn, batch_sizes=None, max_batch_size=None, num_workers=None, threads=None,
+             n_batches=5, n_warmup=2, apply=False, verbose=True):
+    """finds the fastest batch size, number of DataLoader workers and of intra-op threads, in samples/sec,
+    timing a few training batches for every configuration.
+
+    The search is done one parameter at a time: the batch sizes with the current workers and threads,
+    then the workers with the best batch size, then the threads. Batch sizes are tried in increasing order,
+    stopping at the first out of memory. Model, optimizer and rng states are restored after every trial.
+    The trials run with bare_callbacks (device, batch transforms, prefetching, mixed precision) and TimingCB only,
+    the other callbacks aren't run, so learn.recorder, learn.metrics, the schedulers,.. are left unchanged.
+    Inter-op threads can be setted only once per process, before any parallel work, so they aren't tuned.
+
+    Args:
+        learn (Learner): the learner, its train dataloader must be a torch DataLoader (or have a rebuild method)
+        batch_sizes (list, optional): batch sizes to try. Defaults to None, doubling the current one up to max_batch_size.
+        max_batch_size (int, optional): largest batch size of the doubling search. Defaults to None (16x the current one).
+        num_workers (list, optional): workers to try. Defaults to None (0, 2, 4,.. up to the cpu count).
+        threads (list, optional): torch.set_num_threads values to try. Defaults to None (all, half and a quarter of the cpus).
+        n_batches (int, optional): timed batches of every trial. Defaults to 5.
+        n_warmup (int, optional): batches before the timed ones. Defaults to 2.
+        apply (bool, optional): set the best configuration on the learner dataloaders and torch. Defaults to False.
+        verbose (bool, optional): print every trial. Defaults to True.
+
+    Returns:
+        dict: the best configuration (batch_size, num_workers, threads, samples_per_sec, ms_per_batch),
+            all the trials are in its 'trials' list
+    """
+    train = learn.dataloaders.train
+    cpus = os.cpu_count()
+    bs, workers, n_threads = train.batch_size, getattr(train, 'num_workers', 0), torch.get_num_threads()
+    if batch_sizes is None:
+        max_batch_size = max_batch_size or bs * 16
+        batch_sizes = [bs]
+        while batch_sizes[-1] * 2 <= max_batch_size:
+            batch_sizes.append(batch_sizes[-1] * 2)
+    if num_workers is None:
+        num_workers = sorted({0, *range(2, cpus, 2), cpus})
+    if threads is None:
+        threads = sorted({cpus, max(1, cpus // 2), max(1, cpus // 4)}, reverse=True)
+
+    state = learner_state(learn, 0, 0)
+    cbs = bare_callbacks(learn)
+    trials = []
+
+    def run(batch_size, n_workers, n):
+        with isolated_fit(learn, cbs):
+            res = _trial(learn, batch_size, n_workers, n, n_batches, n_warmup)
+            restore_learner(learn, state)
+        set_rng_state(state['rng'])
+        trials.append(res)
+        if verbose:
+            if 'samples_per_sec' in res:
+                print(f'batch_size {batch_size}, num_workers {n_workers}, threads {n}: '
+                      f'{res["samples_per_sec"]:.1f} samples/sec, {res["ms_per_batch"]:.2f} ms/batch')
+            else:
+                print(f'batch_size {batch_size}, num_workers {n_workers}, threads {n}: '
+                      + ('out of memory' if res['oom'] else 'not enough batches'))
+        return res
+
+    def best(results):
+        results = [r for r in results if 'samples_per_sec' in r]
+        return max(results, key=lambda r: r['samples_per_sec']) if results else None
+
+    try:
+        results = []
+        for b in batch_sizes:
+            res = run(b, workers, n_threads)
+            if res.get('oom'):
+                break  # the larger ones don't fit either
+            results.append(res)
+        top = best(results)
+        if top is None:
+            raise RuntimeError('autotune: no batch size fits in memory')
+        top = best([top] + [run(top['batch_size'], w, n_threads) for w in num_workers if w != workers]) or top
+        top = best([top] + [run(top['batch_size'], top['num_workers'], n) for n in threads if n != n_threads]) or top
+    finally:
+        torch.set_num_threads(n_threads)
+
+    top = {**top, 'trials': trials}
+    if verbose:
+        print(f'best: batch_size {top["batch_size"]}, num_workers {top["num_workers"]}, threads {top["threads"]}: '
+              f'{top["samples_per_sec"]:.1f} samples/sec')
+    if apply:
+        dls = learn.dataloaders
+        dls.train = rebuild_dataloader(dls.train, batch_size=top['batch_size'], num_workers=top['num_workers'])
+        dls.valid = rebuild_dataloader(dls.valid, num_workers=top['num_workers'])
+        torch.set_num_threads(top['threads'])
+    return top
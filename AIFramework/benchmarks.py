@@ -0,0 +1,341 @@
+'''
+Micro-benchmarks used to measure the overhead of the framework itself.
+
+example usage:
+from AIFramework.benchmarks import bench_callback_overhead
+bench_callback_overhead(n_batches=2000, n_callbacks=8)
+'''
+import os
+import time
+import threading
+from types import SimpleNamespace
+import torch
+from torch import nn
+
+from .Learner import Learner
+from .callbacks.callbacks import Callback, TrainCB, run_callbacks
+from .callbacks.utilities import MixedPrecisionCB
+
+
+class _NoopCB(Callback):
+    ''' callback that listens to every batch event and does nothing '''
+
+    def before_batch(self, learn): pass
+    def after_predict(self, learn): pass
+    def after_loss(self, learn): pass
+    def after_backward(self, learn): pass
+    def after_step(self, learn): pass
+    def after_batch(self, learn): pass
+    def cleanup_batch(self, learn): pass
+
+
+class _EmptyStepCB(Callback):
+    ''' an empty training step: no model, no loss, no optimizer '''
+
+    def predict(self, learn): pass
+    def get_loss(self, learn): pass
+    def backward(self, learn): pass
+    def step(self, learn): pass
+    def zero_grad(self, learn): pass
+
+
+class _LegacyLearner(Learner):
+    ''' Learner dispatching events without the cached table, as before '''
+
+    def _callback(self, method_name):
+        run_callbacks(self.callbacks, method_name, self)
+
+
+def _time_empty_steps(learner_cls, n_batches, n_callbacks, repeats):
+    dls = SimpleNamespace(train=list(range(n_batches)), valid=[])
+    cbs = [_EmptyStepCB()] + [_NoopCB() for _ in range(n_callbacks)]
+    learn = learner_cls(nn.Identity(), dls, callbacks=cbs, opt_func=None)
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        learn.fit(1, valid=False)
+        best = min(best, time.perf_counter() - start)
+    return best / n_batches
+
+
+def bench_callback_overhead(n_batches=1000, n_callbacks=5, repeats=5, verbose=True):
+    """measures the per-batch overhead of an empty training step,
+    dispatching events with run_callbacks (before) and with the Learner dispatch table (after)
+
+    Args:
+        n_batches (int, optional): batches per timed epoch. Defaults to 1000.
+        n_callbacks (int, optional): number of no-op callbacks listening to batch events. Defaults to 5.
+        repeats (int, optional): timed epochs, the best one is kept. Defaults to 5.
+        verbose (bool, optional): print the results. Defaults to True.
+
+    Returns:
+        dict: microseconds per batch for 'before' and 'after'
+    """
+    res = {
+        'before': _time_empty_steps(_LegacyLearner, n_batches, n_callbacks, repeats) * 1e6,
+        'after': _time_empty_steps(Learner, n_batches, n_callbacks, repeats) * 1e6,
+    }
+    if verbose:
+        print(f'empty step overhead: before {res["before"]:.1f} us/batch, '
+              f'after {res["after"]:.1f} us/batch ({res["before"] / res["after"]:.2f}x)')
+    return res
+
+
+class _ReferenceCNN(nn.Sequential):
+    def __init__(self, n_classes=10):
+        super().__init__(
+            nn.Conv2d(3, 32, 3, stride=2, padding=1), nn.ReLU(),
+            nn.Conv2d(32, 64, 3, stride=2, padding=1), nn.ReLU(),
+            nn.Conv2d(64, 128, 3, stride=2, padding=1), nn.ReLU(),
+            nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(128, n_classes))
+
+
+def _rss_mb():
+    # current resident memory, on linux, otherwise the peak one
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _PeakMemory():
+    ''' peak resident memory above the one at the start, sampled by a thread every `interval` seconds '''
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+
+    def _sample(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, _rss_mb())
+
+    def __enter__(self):
+        self.start = self.peak = _rss_mb()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, _rss_mb())
+
+    @property
+    def mb(self):
+        return self.peak - self.start
+
+
+def _precision_run(dtype, n_steps, batch_size, size):
+    # runs in a fresh process, the memory is measured above the one of the process, data and model
+    torch.manual_seed(0)
+    batches = [(torch.randn(batch_size, 3, size, size), torch.randint(0, 10, (batch_size,))) for _ in range(n_steps)]
+    dls = SimpleNamespace(train=batches, valid=[])
+    cb = TrainCB() if dtype is None else MixedPrecisionCB(dtype=getattr(torch, dtype), device_type='cpu')
+    learn = Learner(_ReferenceCNN(), dls, lr=0.01, callbacks=[cb])
+    with _PeakMemory() as memory:
+        learn.fit(1, valid=False)  # warmup
+        start = time.perf_counter()
+        learn.fit(1, valid=False)
+        ms = (time.perf_counter() - start) * 1000 / n_steps
+    return ms, memory.mb
+
+
+def bench_mixed_precision(n_steps=20, batch_size=64, size=64, verbose=True):
+    """compares fp32 and bf16 (MixedPrecisionCB) training step time and peak memory on cpu,
+    for a reference CNN. Every configuration runs in its own process.
+
+    Args:
+        n_steps (int, optional): timed training steps. Defaults to 20.
+        batch_size (int, optional): batch size. Defaults to 64.
+        size (int, optional): images size. Defaults to 64.
+        verbose (bool, optional): print the results. Defaults to True.
+
+    Returns:
+        dict: ms per step and peak resident memory used by the training (MB, above the memory of the process,
+            data and model before it) for 'fp32' and 'bf16'
+    """
+    import multiprocessing as mp
+    ctx = mp.get_context('spawn')
+    res = {}
+    for name, dtype in (('fp32', None), ('bf16', 'bfloat16')):
+        with ctx.Pool(1) as pool:
+            ms, peak = pool.apply(_precision_run, (dtype, n_steps, batch_size, size))
+        res[name] = {'ms_per_step': ms, 'peak_mb': peak}
+        if verbose:
+            print(f'{name}: {ms:.1f} ms/step, peak training memory {peak:.0f} MB')
+    return res
+
+
+def bench_ensemble(n_members=8, n_batches=50, batch_size=256, verbose=True):
+    """compares training n_members small MLPs one after another (Learner) and together (EnsembleLearner)
+
+    Args:
+        n_members (int, optional): number of models. Defaults to 8.
+        n_batches (int, optional): training batches. Defaults to 50.
+        batch_size (int, optional): batch size. Defaults to 256.
+        verbose (bool, optional): print the results. Defaults to True.
+
+    Returns:
+        dict: seconds for 'sequential' and 'ensemble'
+    """
+    from .ensemble import EnsembleLearner, EnsembleTrainCB
+
+    def model():
+        return nn.Sequential(nn.Linear(64, 128), nn.ReLU(), nn.Linear(128, 10))
+    batches = [(torch.randn(batch_size, 64), torch.randint(0, 10, (batch_size,))) for _ in range(n_batches)]
+    dls = SimpleNamespace(train=batches, valid=[])
+    start = time.perf_counter()
+    for _ in range(n_members):
+        Learner(model(), dls, callbacks=[TrainCB()]).fit(1, valid=False)
+    res = {'sequential': time.perf_counter() - start}
+    learn = EnsembleLearner([model() for _ in range(n_members)], dls, callbacks=[EnsembleTrainCB()])
+    start = time.perf_counter()
+    learn.fit(1, valid=False)
+    res['ensemble'] = time.perf_counter() - start
+    if verbose:
+        print(f'{n_members} models: sequential {res["sequential"]:.2f}s, ensemble {res["ensemble"]:.2f}s '
+              f'({res["sequential"] / res["ensemble"]:.2f}x)')
+    return res
+
+
+_HEAVY_MODULES = ('matplotlib', 'accelerate', 'torcheval', 'fastprogress')
+
+
+def bench_import_time(module='AIFramework.callbacks', repeats=3, check=True, verbose=True):
+    """measures the import time of module in a fresh interpreter, and the time of torch alone.
+    With check, it fails if the import loads any of the heavy optional dependencies
+    (matplotlib, accelerate, torcheval, fastprogress), which must be imported on first use.
+
+    Args:
+        module (str, optional): module to import. Defaults to 'AIFramework.callbacks'.
+        repeats (int, optional): imports, the best one is kept. Defaults to 3.
+        check (bool, optional): raise AssertionError if a heavy dependency is imported. Defaults to True.
+        verbose (bool, optional): print the results. Defaults to True.
+
+    Returns:
+        dict: seconds for 'torch' and module, and the heavy modules it 'loaded'
+    """
+    import json
+    import subprocess
+    import sys
+    code = ('import sys, time, json; t = time.perf_counter(); import {}; t = time.perf_counter() - t; '
+            'print(json.dumps([t, sorted({{m.split(".")[0] for m in sys.modules}} & set({}))]))')
+    res = {}
+    for name in ('torch', module):
+        best, loaded = float('inf'), []
+        for _ in range(repeats):
+            out = subprocess.run([sys.executable, '-c', code.format(name, list(_HEAVY_MODULES))],
+                                 capture_output=True, text=True, check=True).stdout
+            t, loaded = json.loads(out.splitlines()[-1])
+            best = min(best, t)
+        res[name] = best
+    res['loaded'] = loaded
+    if verbose:
+        print(f'import torch {res["torch"]:.2f}s, import {module} {res[module]:.2f}s '
+              f'({res[module] - res["torch"]:+.2f}s), heavy modules loaded: {loaded or "none"}')
+    if check:
+        assert not loaded, f'{module} imports {loaded} eagerly'
+    return res
+
+
+def bench_dataloader(n_samples=60000, n_features=784, batch_size=256, verbose=True):
+    """compares an epoch of a shuffled torch DataLoader over a TensorDataset with TensorDataLoader
+
+    Args:
+        n_samples (int, optional): dataset size. Defaults to 60000.
+        n_features (int, optional): features of every sample. Defaults to 784.
+        batch_size (int, optional): batch size. Defaults to 256.
+        verbose (bool, optional): print the results. Defaults to True.
+
+    Returns:
+        dict: seconds per epoch for 'DataLoader' and 'TensorDataLoader'
+    """
+    from torch.utils.data import DataLoader, TensorDataset
+    from .data import TensorDataLoader
+    x, y = torch.randn(n_samples, n_features), torch.randint(0, 10, (n_samples,))
+    res = {}
+    for name, dl in (('DataLoader', DataLoader(TensorDataset(x, y), batch_size, shuffle=True)),
+                     ('TensorDataLoader', TensorDataLoader(x, y, batch_size=batch_size, shuffle=True))):
+        start = time.perf_counter()
+        for _ in dl:
+            pass
+        res[name] = time.perf_counter() - start
+    if verbose:
+        print(f'epoch of {n_samples} samples: DataLoader {res["DataLoader"]:.3f}s, '
+              f'TensorDataLoader {res["TensorDataLoader"]:.3f}s ({res["DataLoader"] / res["TensorDataLoader"]:.1f}x)')
+    return res
+
+
+def bench_memmap(n_samples=100000, n_features=784, batch_size=256, path=None, verbose=True):
+    """compares an epoch of a MemmapDataset read sample by sample (the default collate of a shuffled DataLoader),
+    in shuffled batches of scattered samples and with the block shuffling of memmap_dataloader (range reads)
+
+    Args:
+        n_samples (int, optional): dataset size. Defaults to 100000.
+        n_features (int, optional): features of every sample. Defaults to 784.
+        batch_size (int, optional): batch size. Defaults to 256.
+        path (str, optional): directory of the converted dataset. Defaults to None (a temporary one).
+        verbose (bool, optional): print the results. Defaults to True.
+
+    Returns:
+        dict: seconds per epoch for 'per sample', 'scattered' and 'blocks'
+    """
+    import tempfile
+    from torch.utils.data import DataLoader, TensorDataset
+    from .data import convert_dataset, memmap_collate, memmap_dataloader
+    x, y = torch.randn(n_samples, n_features), torch.randint(0, 10, (n_samples,))
+    with tempfile.TemporaryDirectory() as tmp:
+        ds = convert_dataset(TensorDataset(x, y), path or tmp, batch_size=4096)
+        samples = DataLoader(range(n_samples), batch_size, shuffle=True,
+                             collate_fn=lambda idx: torch.utils.data.default_collate([ds[i] for i in idx]))
+        res = {}
+        for name, dl in (('per sample', samples),
+                         ('scattered', DataLoader(ds, batch_size, shuffle=True, collate_fn=memmap_collate)),
+                         ('blocks', memmap_dataloader(ds, batch_size, shuffle=True))):
+            start = time.perf_counter()
+            for _ in dl:
+                pass
+            res[name] = time.perf_counter() - start
+    if verbose:
+        print(f'epoch of {n_samples} samples: ' + ', '.join(f'{k} {v:.3f}s' for k, v in res.items())
+              + f' (blocks {res["per sample"] / res["blocks"]:.1f}x faster than per sample)')
+    return res
+
+
+def bench_quantization(model, quantized, xs, batch_sizes=(1, 32, 256), n_iters=20, n_warmup=3, verbose=True):
+    """compares the cpu inference speed of a fp32 model and its quantized copy at several batch sizes
+
+    Args:
+        model (nn.Module): the fp32 model
+        quantized (nn.Module): the quantized model
+        xs (tuple): a batch of model inputs, its samples are repeated to build the batches
+        batch_sizes (list, optional): batch sizes to time. Defaults to (1, 32, 256).
+        n_iters (int, optional): timed forwards for every batch size. Defaults to 20.
+        n_warmup (int, optional): forwards before the timed ones. Defaults to 3.
+        verbose (bool, optional): print the results. Defaults to True.
+
+    Returns:
+        dict: batch size -> {'fp32': (ms per batch, samples/sec), 'int8': (ms per batch, samples/sec)}
+    """
+    models = {'fp32': model.cpu().eval(), 'int8': quantized.eval()}
+    res = {}
+    for bs in batch_sizes:
+        idx = torch.arange(bs) % len(xs[0])
+        batch = tuple(x.cpu()[idx] for x in xs)
+        res[bs] = {}
+        with torch.inference_mode():
+            for name, m in models.items():
+                for _ in range(n_warmup):
+                    m(*batch)
+                start = time.perf_counter()
+                for _ in range(n_iters):
+                    m(*batch)
+                secs = (time.perf_counter() - start) / n_iters
+                res[bs][name] = secs * 1000, bs / secs
+        if verbose:
+            (f_ms, f_sps), (q_ms, q_sps) = res[bs]['fp32'], res[bs]['int8']
+            print(f'batch size {bs}: fp32 {f_ms:.2f} ms ({f_sps:.0f} samples/sec), '
+                  f'int8 {q_ms:.2f} ms ({q_sps:.0f} samples/sec), {f_ms / q_ms:.2f}x')
+    return res
@@ -5,3 +5,43 @@ from .metrics import *
 from .initialization import *
 from .scheduler import *
 from .utilities import *
+from .prefetch import *
+from .checkpoint import *
+from .profiler import *
+from .distributed import *
+from .sink import *
+from .early_stopping import *
+from .validation import *
+
+# heavy dependencies are imported on first use, these names are still importable from the package
+_lazy = {
+    'plt': ('matplotlib.pyplot', None),
+    'Accelerator': ('accelerate', 'Accelerator'),
+    'MulticlassAccuracy': ('torcheval.metrics', 'MulticlassAccuracy'),
+    'Mean': ('torcheval.metrics', 'Mean'),
+    'sync_and_compute': ('torcheval.metrics.toolkit', 'sync_and_compute'),
+    'progress_bar': ('fastprogress', 'progress_bar'),
+    'master_bar': ('fastprogress', 'master_bar'),
+    'get_grid': ('AIFramework.callbacks.plotCharts.utils', 'get_grid'),
+    'show_image': ('AIFramework.callbacks.plotCharts.utils', 'show_image'),
+    'get_hist': ('AIFramework.callbacks.plotCharts.utils', 'get_hist'),
+    'get_min': ('AIFramework.callbacks.plotCharts.utils', 'get_min'),
+}
+
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    import importlib
+    module, attr = _lazy[name]
+    value = importlib.import_module(module)
+    return value if attr is None else getattr(value, attr)
+
+
+def __dir__():
+    return sorted([*globals(), *_lazy])
+
+
+# the lazy names aren't in __all__, so `from AIFramework.callbacks import *` doesn't import
+# their modules, import them by name (`from AIFramework.callbacks import MulticlassAccuracy`)
+__all__ = [k for k in globals() if not k.startswith('_')]
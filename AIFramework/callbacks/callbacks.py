@@ -12,11 +12,19 @@ class Callback():
     order = 0
 
 
-def run_callbacks(callbacks, method_name, learn=None):
+def get_callback_methods(callbacks, method_name):
+    ''' returns the bound methods named method_name of callbacks, sorted by callback order '''
+    methods = []
     for callback in sorted(callbacks, key=attrgetter('order')):
         method = getattr(callback, method_name, None)
         if method is not None:
-            method(learn)
+            methods.append(method)
+    return methods
+
+
+def run_callbacks(callbacks, method_name, learn=None):
+    for method in get_callback_methods(callbacks, method_name):
+        method(learn)
 
 
 class Hook():
@@ -55,7 +63,7 @@ class Hooks(list):
 
 
 class HooksCallback(Callback):
-    def __init__(self, hookfunc, mod_filter=fc.noop, on_train=True, on_valid=False, mods=None):
+    def __init__(self, hookfunc, mod_filter=fc.noop, on_train=True, on_valid=False, mods=None, every=1):
         """
         Args:
             hookfunc (fn): _description_
@@ -63,6 +71,7 @@ class HooksCallback(Callback):
             on_train (bool, optional): _description_. Defaults to True.
             on_valid (bool, optional): _description_. Defaults to False.
             mods (_type_, optional): _description_. Defaults to None.
+            every (int, optional): run hookfunc only every `every` batches. Defaults to 1.
         """
         fc.store_attr()
         super().__init__()
@@ -77,7 +86,8 @@ class HooksCallback(Callback):
 
     def _hookfunc(self, learn, *args, **kwargs):
         if (self.on_train and learn.training) or (self.on_valid and not learn.training):
-            self.hookfunc(*args, **kwargs)
+            if self.every == 1 or learn.iter % self.every == 0:
+                self.hookfunc(*args, **kwargs)
 
     def after_fit(self, learn):
         self.hooks.remove()
@@ -0,0 +1,181 @@
+import os
+import glob
+import queue
+import random
+import threading
+from typing import Mapping
+import numpy as np
+import torch
+from torch import nn
+from .callbacks import Callback
+
+__all__ = ['get_rng_state', 'set_rng_state', 'snapshot', 'unwrap_model', 'learner_state', 'restore_learner',
+           'latest_checkpoint', 'load_checkpoint', 'save_checkpoint', 'CheckpointCB']
+
+
+def get_rng_state():
+    state = {'torch': torch.get_rng_state(), 'random': random.getstate(), 'numpy': np.random.get_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot(x):
+    ''' copy of a (nested) state dict with all the tensors copied to cpu '''
+    if isinstance(x, torch.Tensor):
+        return x.detach().to('cpu', copy=True)
+    if isinstance(x, Mapping):
+        return {k: snapshot(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(snapshot(o) for o in x)
+    return x
+
+
+def unwrap_model(model):
+    ''' the module wrapped by torch.compile and DistributedDataParallel '''
+    while True:
+        if hasattr(model, '_orig_mod'):
+            model = model._orig_mod
+        elif isinstance(model, nn.parallel.DistributedDataParallel):
+            model = model.module
+        else:
+            return model
+
+
+def learner_state(learn, epoch, iter, epoch_rng=None, valid_pending=False):
+    """in memory snapshot of the training state
+
+    Args:
+        learn (Learner): the learner
+        epoch (int): epoch to resume from
+        iter (int): training batches of epoch already consumed
+        epoch_rng (dict, optional): rng state at the start of epoch, it replays the dataloader shuffling.
+            Defaults to None (current rng state).
+        valid_pending (bool, optional): saved at the end of the training of epoch-1, before its validation,
+            that runs again on resume. Defaults to False.
+
+    Returns:
+        dict: the state
+    """
+    rng = get_rng_state()
+    scheduler, scaler = getattr(learn, 'scheduler', None), getattr(learn, 'scaler', None)
+    return {
+        'epoch': epoch,
+        'iter': iter,
+        'model': snapshot(unwrap_model(learn.model).state_dict()),
+        'opt': snapshot(learn.opt.state_dict()) if getattr(learn, 'opt', None) is not None else None,
+        'scheduler': snapshot(scheduler.state_dict()) if scheduler is not None else None,
+        'scaler': snapshot(scaler.state_dict()) if scaler is not None else None,
+        'rng': rng,
+        'epoch_rng': rng if epoch_rng is None else epoch_rng,
+        'valid_pending': valid_pending,
+    }
+
+
+def restore_learner(learn, state):
+    ''' loads model, optimizer, scheduler and grad scaler states, rng states are restored by the Learner '''
+    unwrap_model(learn.model).load_state_dict(state['model'])
+    if state['opt'] is not None and getattr(learn, 'opt', None) is not None:
+        learn.opt.load_state_dict(state['opt'])
+    if state['scheduler'] is not None and getattr(learn, 'scheduler', None) is not None:
+        learn.scheduler.load_state_dict(state['scheduler'])
+    if state['scaler'] is not None and getattr(learn, 'scaler', None) is not None:
+        learn.scaler.load_state_dict(state['scaler'])
+
+
+def latest_checkpoint(path):
+    ''' last checkpoint file saved by CheckpointCB in the directory path '''
+    files = sorted(glob.glob(os.path.join(path, 'ckpt_*.pt')))
+    if not files:
+        raise FileNotFoundError(f'no checkpoints in {path}')
+    return files[-1]
+
+
+def load_checkpoint(path):
+    ''' loads a checkpoint file, or the latest one if path is a directory '''
+    if os.path.isdir(path):
+        path = latest_checkpoint(path)
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def save_checkpoint(state, path):
+    tmp = f'{path}.tmp'
+    torch.save(state, tmp)
+    os.replace(tmp, path)  # a crash while writing never leaves a truncated checkpoint
+
+
+class CheckpointCB(Callback):
+    """Saves model, optimizer, scheduler, grad scaler and rng states every `every_batches` batches
+    and/or every `every_epochs` epochs.
+    The state is copied in memory and written to disk by a background thread,
+    the training blocks only if the previous checkpoint is still being written.
+
+    resume with learn.fit(n_epochs, resume=path)
+
+    example usage:
+    learn.fit(10, callbacks=[CheckpointCB('checkpoints', every_batches=500)])
+    """
+    order = 100  # saves after all the callbacks updated their states
+
+    def __init__(self, path, every_batches=None, every_epochs=1, keep=2):
+        """
+        Args:
+            path (str): directory of the checkpoints
+            every_batches (int, optional): save every `every_batches` training batches. Defaults to None.
+            every_epochs (int, optional): save every `every_epochs` training epochs. Defaults to 1.
+            keep (int, optional): number of last checkpoints kept on disk. Defaults to 2.
+        """
+        self.path, self.every_batches, self.every_epochs, self.keep = path, every_batches, every_epochs, keep
+
+    def _writer(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                file, state = item
+                save_checkpoint(state, file)
+                self.saved.append(file)
+                while len(self.saved) > self.keep:
+                    os.remove(self.saved.pop(0))
+            except Exception as e:
+                print(f'checkpoint failed: {e}')
+            finally:
+                self.queue.task_done()
+
+    def before_fit(self, learn):
+        os.makedirs(self.path, exist_ok=True)
+        self.saved = sorted(glob.glob(os.path.join(self.path, 'ckpt_*.pt')))
+        self.queue = queue.Queue(1)
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def _save(self, learn, epoch, iter, epoch_rng=None, valid_pending=False):
+        state = learner_state(learn, epoch, iter, epoch_rng, valid_pending)
+        self.queue.put((os.path.join(self.path, f'ckpt_{epoch:04d}_{iter:07d}.pt'), state))
+
+    def before_epoch(self, learn):
+        if learn.training:
+            self.epoch_rng = get_rng_state()
+
+    def after_batch(self, learn):
+        if learn.training and learn.stepped and self.every_batches and (learn.iter+1) % self.every_batches == 0:
+            self._save(learn, learn.epoch, learn.iter+1, self.epoch_rng)
+
+    def after_epoch(self, learn):
+        if learn.training and self.every_epochs and (learn.epoch+1) % self.every_epochs == 0:
+            # saved before the validation of the epoch, a fit resumed from it runs the validation first
+            self._save(learn, learn.epoch+1, 0, valid_pending=True)
+
+    def cleanup_fit(self, learn):
+        self.queue.join()  # waits for the last write
+        self.queue.put(None)
+        self.thread.join()
@@ -3,18 +3,28 @@ import fastcore.all as fc
 from typing import Mapping
 from .callbacks import Callback
 
-def to_device(x, device):
+def to_device(x, device, non_blocking=False):
     if isinstance(x, torch.Tensor):
-        return x.to(device)
+        return x.to(device, non_blocking=non_blocking)
     if isinstance(x, Mapping):
-        return {k: v.to(device) for k, v in x.items()}
-    return type(x)(to_device(o, device) for o in x)
+        return {k: v.to(device, non_blocking=non_blocking) for k, v in x.items()}
+    return type(x)(to_device(o, device, non_blocking) for o in x)
+
+
+def pin_memory(x):
+    if isinstance(x, torch.Tensor):
+        return x.pin_memory() if x.device.type == 'cpu' else x
+    if isinstance(x, Mapping):
+        return {k: pin_memory(v) for k, v in x.items()}
+    return type(x)(pin_memory(o) for o in x)
 
 
 class DeviceCB(Callback):
     """ Callback used to set device
         where calcs are performed
     """
+    prefetched = False  # setted by PrefetchCB when it moves the batches in background
+
     def __init__(self, device):
         """
         Args:
@@ -26,8 +36,13 @@ class DeviceCB(Callback):
         if hasattr(learn.model, 'to'):
             learn.model.to(self.device)
 
+    def transform_batch(self, batch, training):
+        # prefetched batches are pinned, so the copy can be asynchronous
+        return to_device(batch, device=self.device, non_blocking=self.prefetched)
+
     def before_batch(self, learn):
-        learn.batch = to_device(learn.batch, device=self.device)
+        if not self.prefetched:
+            learn.batch = self.transform_batch(learn.batch, learn.training)
 
 
 def get_device_cb(device):
@@ -0,0 +1,142 @@
+'''
+Data parallel training on local processes with torch.distributed, without Accelerate.
+
+From python:
+    def train(rank, world_size):
+        learn = Learner(model, dls, callbacks=[DistributedCB(), MetricsCB(...), ProgressCB()])
+        learn.fit(3)
+    launch(train, nprocs=4)
+
+From the command line, running a script that adds DistributedCB to its learner:
+    python -m AIFramework.callbacks.distributed --nprocs 4 train.py [script args]
+'''
+import os
+import sys
+import socket
+import argparse
+import subprocess
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+from .callbacks import Callback
+from .device import DeviceCB
+from .utils import is_shuffled, rebuild_dataloader
+
+__all__ = ['DistributedCB', 'launch']
+
+
+class DistributedCB(Callback):
+    """Data parallel training across the processes of torch.distributed.
+
+    The model is wrapped in DistributedDataParallel and the train dataloader is sharded with a DistributedSampler.
+    The valid dataloader is split in contiguous parts without padding, every sample is validated once,
+    so the metrics MetricsCB reduces across the processes are the ones of a single process.
+    Only the rank 0 process logs them and drives ProgressCB.
+
+    If the process group is not initialized yet, it's initialized from the environment variables
+    (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT) set by launch or the command line launcher.
+    """
+    order = DeviceCB.order+1  # wraps the model moved on its device
+
+    def __init__(self, backend='gloo', find_unused_parameters=False):
+        """
+        Args:
+            backend (str, optional): torch.distributed backend, gloo runs on cpu. Defaults to 'gloo'.
+            find_unused_parameters (bool, optional): DistributedDataParallel find_unused_parameters. Defaults to False.
+        """
+        self.backend, self.find_unused_parameters = backend, find_unused_parameters
+        if not dist.is_initialized() and 'WORLD_SIZE' in os.environ:
+            # started by the launcher: the rank is known before the other callbacks run
+            dist.init_process_group(backend)
+
+    def _shard(self, dl):
+        if hasattr(dl.sampler, 'shard'):  # samplers that split themselves between the processes, like BlockSampler
+            sampler = dl.sampler.shard(dist.get_rank(), dist.get_world_size())
+        else:
+            sampler = DistributedSampler(dl.dataset, shuffle=is_shuffled(dl.sampler))
+        return rebuild_dataloader(dl, sampler=sampler, shuffle=None)
+
+    def _split(self, dl):
+        # DistributedSampler and BlockSampler.shard pad the shards to the same length, duplicating samples.
+        # A contiguous part for every process keeps the range reads of MemmapDataset
+        idx = sorted(dl.sampler) if is_shuffled(dl.sampler) else list(dl.sampler)
+        rank, world_size, n = dist.get_rank(), dist.get_world_size(), len(idx)
+        return rebuild_dataloader(dl, sampler=idx[rank * n // world_size:(rank + 1) * n // world_size], shuffle=None)
+
+    def before_fit(self, learn):
+        if not dist.is_initialized():
+            dist.init_process_group(self.backend)
+        learn.rank, learn.world_size = dist.get_rank(), dist.get_world_size()
+        dls = learn.dataloaders
+        self.dls = dls.train, dls.valid
+        dls.train, dls.valid = self._shard(dls.train), self._split(dls.valid)
+        device = next(learn.model.parameters()).device
+        learn.model = DistributedDataParallel(learn.model, device_ids=[device.index] if device.type == 'cuda' else None,
+                                              find_unused_parameters=self.find_unused_parameters)
+
+    def before_epoch(self, learn):
+        sampler = getattr(learn.dl, 'sampler', None)
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(learn.epoch)  # a different shuffling every epoch
+
+    def cleanup_fit(self, learn):
+        if isinstance(learn.model, DistributedDataParallel):
+            learn.model = learn.model.module
+        learn.dataloaders.train, learn.dataloaders.valid = self.dls
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _set_env(rank, nprocs, port, threads):
+    os.environ.update(RANK=str(rank), LOCAL_RANK=str(rank), WORLD_SIZE=str(nprocs),
+                      MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), OMP_NUM_THREADS=str(threads))
+
+
+def _worker(rank, fn, nprocs, backend, port, threads, args):
+    _set_env(rank, nprocs, port, threads)
+    torch.set_num_threads(threads)
+    dist.init_process_group(backend, rank=rank, world_size=nprocs)
+    try:
+        fn(rank, nprocs, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn, nprocs=None, backend='gloo', args=()):
+    """runs fn(rank, world_size, *args) in nprocs local processes, with the process group initialized.
+    The cpu cores are split among the processes, to not oversubscribe them.
+
+    Args:
+        fn (fn): training function, it must be picklable (defined at module level)
+        nprocs (int, optional): number of processes. Defaults to None (cpu count).
+        backend (str, optional): torch.distributed backend. Defaults to 'gloo'.
+        args (tuple, optional): other fn arguments. Defaults to ().
+    """
+    nprocs = nprocs or os.cpu_count()
+    threads = max(1, os.cpu_count() // nprocs)
+    mp.spawn(_worker, args=(fn, nprocs, backend, _free_port(), threads, args), nprocs=nprocs)
+
+
+def _cli():
+    parser = argparse.ArgumentParser(description='runs a training script in N local processes')
+    parser.add_argument('--nprocs', type=int, default=os.cpu_count())
+    parser.add_argument('script')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER)
+    opts = parser.parse_args()
+    port, threads = _free_port(), max(1, os.cpu_count() // opts.nprocs)
+    procs = []
+    for rank in range(opts.nprocs):
+        _set_env(rank, opts.nprocs, port, threads)
+        procs.append(subprocess.Popen([sys.executable, opts.script, *opts.script_args], env=os.environ.copy()))
+    codes = [p.wait() for p in procs]
+    sys.exit(max(codes, key=abs))
+
+
+if __name__ == '__main__':
+    _cli()
@@ -0,0 +1,98 @@
+import math
+import torch
+import torch.distributed as dist
+from .callbacks import Callback
+from .metrics import MetricsCB
+from .checkpoint import snapshot, unwrap_model
+from .utils import is_distributed, is_main_process
+from ..exceptions import CancelFitException
+
+__all__ = ['EarlyStoppingCB']
+
+
+class EarlyStoppingCB(Callback):
+    """Stops the training when a MetricsCB metric, computed on the validation epochs,
+    doesn't improve for `patience` epochs, and restores the best weights at the end of fit.
+    The best weights are kept in memory (on cpu), no checkpoint file is written.
+
+    The divergence guard stops the training when the loss becomes NaN or inf.
+    The non finite losses are counted on the learner device, and the host reads the counter
+    only every `check_every` batches, so the training loop doesn't sync on every batch.
+
+    learn.stop_reason is 'patience' or 'divergence' when the training has been stopped, otherwise None.
+
+    example usage:
+    learn.fit(50, callbacks=[EarlyStoppingCB('accuracy', mode='max', patience=5)])
+    """
+    order = MetricsCB.order+1  # reads the metrics computed in after_epoch
+
+    def __init__(self, monitor='loss', mode='min', patience=3, min_delta=0., restore_best=True,
+                 check_every=50, divergence=True):
+        """
+        Args:
+            monitor (str, optional): name of the MetricsCB metric. Defaults to 'loss'.
+            mode (str, optional): 'min' or 'max', the direction of improvement. Defaults to 'min'.
+            patience (int, optional): validation epochs without improvement before stopping. Defaults to 3.
+            min_delta (float, optional): minimum change that counts as an improvement. Defaults to 0.
+            restore_best (bool, optional): load the weights of the best epoch at the end of fit. Defaults to True.
+            check_every (int, optional): training batches between two reads of the divergence counter. Defaults to 50.
+            divergence (bool, optional): enable the divergence guard. Defaults to True.
+        """
+        assert mode in ('min', 'max'), f'unknown mode {mode}'
+        self.monitor, self.mode, self.patience, self.min_delta = monitor, mode, patience, min_delta
+        self.restore_best, self.check_every, self.divergence = restore_best, check_every, divergence
+
+    def before_fit(self, learn):
+        self.best, self.best_epoch, self.best_state = None, None, None
+        self.wait = 0
+        self.n_bad = None
+        learn.stop_reason = None
+
+    def _improved(self, value):
+        if self.best is None:
+            return True
+        if self.mode == 'min':
+            return value < self.best - self.min_delta
+        return value > self.best + self.min_delta
+
+    def after_batch(self, learn):
+        if not self.divergence or not learn.training:
+            return
+        bad = (~torch.isfinite(learn.loss.detach())).sum()
+        self.n_bad = bad if self.n_bad is None else self.n_bad + bad
+        if (learn.iter + 1) % self.check_every == 0:
+            self._check_divergence(learn)
+
+    def _check_divergence(self, learn):
+        n_bad = self.n_bad
+        if is_distributed():  # every process stops at the same batch
+            n_bad = n_bad.clone()
+            dist.all_reduce(n_bad)
+        if n_bad.item():
+            learn.stop_reason = 'divergence'
+            if is_main_process():
+                print(f'early stopping: non finite loss at epoch {learn.epoch}')
+            raise CancelFitException()
+
+    def after_epoch(self, learn):
+        if learn.training:
+            if self.divergence and self.n_bad is not None:
+                self._check_divergence(learn)
+            return
+        value = learn.metrics.values[self.monitor]
+        if math.isfinite(value) and self._improved(value):
+            self.best, self.best_epoch, self.wait = value, learn.epoch, 0
+            if self.restore_best:
+                self.best_state = snapshot(unwrap_model(learn.model).state_dict())
+            return
+        self.wait += 1
+        if self.wait >= self.patience:
+            learn.stop_reason = 'patience'
+            if is_main_process():
+                print(f'early stopping at epoch {learn.epoch}, best {self.monitor} {self.best:.4f} at epoch {self.best_epoch}')
+            raise CancelFitException()
+
+    def cleanup_fit(self, learn):
+        if self.restore_best and self.best_state is not None:
+            unwrap_model(learn.model).load_state_dict(self.best_state)
+        self.best_state = None
@@ -1,7 +1,87 @@
-import numpy as np
+import os
+from collections import OrderedDict
 import fastcore.all as fc
+import torch
+from torch.utils.data import DataLoader
 from .callbacks import Callback
-from .utils import to_cpu
+from .utils import is_shuffled
+
+
+def _nbytes(x):
+    if isinstance(x, torch.Tensor):
+        return x.nelement() * x.element_size()
+    if isinstance(x, (list, tuple)):
+        return sum(_nbytes(o) for o in x)
+    if isinstance(x, dict):
+        return sum(_nbytes(o) for o in x.values())
+    return 0
+
+
+class BatchCache():
+    """LRU store of batches, limited to max_bytes.
+    With a path, the batches evicted from memory are saved there and loaded back memory mapped.
+    """
+
+    def __init__(self, max_bytes=2**30, path=None):
+        """
+        Args:
+            max_bytes (int, optional): memory used by the cached batches. Defaults to 1GB.
+            path (str, optional): directory of the disk tier. Defaults to None (memory only).
+        """
+        self.max_bytes, self.path = max_bytes, path
+        self.items, self.nbytes = OrderedDict(), 0
+        self.on_disk = set()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, '_'.join(map(str, key)) + '.pt')
+
+    def __contains__(self, key):
+        return key in self.items or key in self.on_disk
+
+    def get(self, key):
+        if key in self.items:
+            self.items.move_to_end(key)
+            return self.items[key][0]
+        if key in self.on_disk:
+            return torch.load(self._file(key), mmap=True)
+        return None
+
+    def put(self, key, batch):
+        n = _nbytes(batch)
+        if n > self.max_bytes:
+            return
+        self.items[key] = batch, n
+        self.nbytes += n
+        while self.nbytes > self.max_bytes:
+            old_key, (old, old_n) = self.items.popitem(last=False)
+            self.nbytes -= old_n
+            if self.path is not None and old_key not in self.on_disk:
+                torch.save(old, self._file(old_key))
+                self.on_disk.add(old_key)
+
+    def clear(self):
+        for key in self.on_disk:
+            os.remove(self._file(key))
+        self.items, self.nbytes, self.on_disk = OrderedDict(), 0, set()
+
+
+class _CachedEpoch():
+    ''' the batches of an epoch replayed from the cache, without loading them '''
+
+    def __init__(self, cache, key, n, dl):
+        self.cache, self.key, self.n = cache, key, n
+        self.generator = dl.generator if isinstance(dl, DataLoader) else False
+
+    def __iter__(self):
+        if self.generator is not False:
+            # draws the seed drawn by a DataLoader iterator, so the rng state is the same as without the cache
+            torch.empty((), dtype=torch.int64).random_(generator=self.generator)
+        return (self.cache.get((*self.key, i)) for i in range(self.n))
+
+    def __len__(self):
+        return self.n
 
 
 class BatchTransformCB(Callback):
@@ -11,46 +91,102 @@ class BatchTransformCB(Callback):
         example: used to normalize data batches during initialization
     """
 
-    def __init__(self, normalize_fn, on_train=True, on_val=True, print_means=False):
+    prefetched = False  # setted by PrefetchCB when it transforms the batches in background
+
+    def __init__(self, normalize_fn, on_train=True, on_val=True, print_means=False,
+                 cache=False, cache_bytes=2**30, cache_dir=None):
         """
         Args:
             normalize_fn (fn): function executed to normalize input data
             on_train (bool, optional): training mode. Defaults to True.
             on_val (bool, optional): validate mode. Defaults to True.
             print_means (bool, optional): if is setted print the mean and std values of the batches after every epoch. Defaults to False.
+            cache (bool, optional): cache the transformed batches of the dataloaders that aren't shuffled,
+                for deterministic normalize_fn only. When all the batches of an epoch are cached,
+                they are replayed without loading them. Not used with PrefetchCB. Defaults to False.
+            cache_bytes (int, optional): memory used by the cache. Defaults to 1GB.
+            cache_dir (str, optional): directory of the disk tier of the cache, it stores the batches
+                evicted from memory. Defaults to None.
         """
         fc.store_attr()
+        self.batch_cache = BatchCache(cache_bytes, cache_dir) if cache else None
+        self.sources = {}  # keeps datasets and samplers of the cache keys alive, so their ids aren't reused
+        self.after_init(None)  # callbacks passed to fit don't get after_init
 
     def after_init(self, learn):
         self.record_means = {}
+        self.keys, self.stats = {}, {}
+
+    def _cache_key(self, dl):
+        if self.batch_cache is None or self.prefetched or is_shuffled(getattr(dl, 'sampler', None)):
+            return None
+        dataset, sampler = getattr(dl, 'dataset', dl), getattr(dl, 'sampler', None)
+        key = (id(dataset), id(sampler), getattr(dl, 'batch_size', None))
+        self.sources[key] = dataset, sampler
+        return key
 
     def before_epoch(self, learn):
-        if self.print_means:
-            self.record_means[learn.epoch] = {
-                "means": [],
-                "stds": []
-            }
+        # state of every phase, a validation in the middle of a training epoch doesn't reset the training one
+        key, replay = None, False
+        if self._active(learn.training):
+            key = self._cache_key(learn.dl)
+        if key is not None:
+            try:
+                n = len(learn.dl)
+            except TypeError:
+                n = None
+            if n is not None and all((*key, i) in self.batch_cache for i in range(n)):
+                learn.dl, replay = _CachedEpoch(self.batch_cache, key, n, learn.dl), True
+        self.keys[learn.training] = key, replay
+        self.stats[learn.training] = None
+
+    def _active(self, training):
+        return (self.on_train and training) or (self.on_val and not training)
+
+    def transform_batch(self, batch, training):
+        return self.normalize_fn(batch) if self._active(training) else batch
+
+    def _cached_transform(self, learn, key):
+        key = (*key, learn.iter)
+        batch = self.batch_cache.get(key)
+        if batch is None:
+            batch = self.normalize_fn(learn.batch)
+            self.batch_cache.put(key, batch)
+        return batch
 
     def before_batch(self, learn):
-        if (self.on_train and learn.training) or (self.on_val and not learn.training):
+        if not self._active(learn.training):
+            return
+        key, replay = self.keys[learn.training]
+        if key is not None:
+            if not replay:  # replayed batches come from the cache already transformed
+                learn.batch = self._cached_transform(learn, key)
+        elif not self.prefetched:
             learn.batch = self.normalize_fn(learn.batch)
-            if self.print_means:
-                self.record_means[learn.epoch]['means'].append(
-                    learn.batch[0].mean())
-                self.record_means[learn.epoch]['stds'].append(
-                    learn.batch[0].std())
-
-    def after_epoch(self, learn):
         if self.print_means:
+            self._update_stats(learn.training, learn.batch[0])
 
-            mean_mean = np.mean(
-                to_cpu(self.record_means[learn.epoch]['means']))
-            mean_min = np.min(to_cpu(self.record_means[learn.epoch]['means']))
-            mean_max = np.max(to_cpu(self.record_means[learn.epoch]['means']))
+    def _update_stats(self, training, x):
+        # running sum, min and max of the batch means and stds, on the batch device
+        ms = torch.stack([x.mean(), x.std()]).float()
+        stats = self.stats[training]
+        if stats is None:
+            self.stats[training] = torch.stack([ms, ms, ms]), 1
+            return
+        stats, n = stats
+        stats[0] += ms
+        torch.minimum(stats[1], ms, out=stats[1])
+        torch.maximum(stats[2], ms, out=stats[2])
+        self.stats[training] = stats, n + 1
 
-            std_mean = np.mean(to_cpu(self.record_means[learn.epoch]['stds']))
-            std_min = np.min(to_cpu(self.record_means[learn.epoch]['stds']))
-            std_max = np.max(to_cpu(self.record_means[learn.epoch]['stds']))
+    def after_epoch(self, learn):
+        if self.print_means and self.stats.get(learn.training) is not None:
+            stats, n = self.stats[learn.training]
+            stats = stats.cpu()  # the only sync of the epoch
+            stats[0] /= n
+            (mean_mean, std_mean), (mean_min, std_min), (mean_max, std_max) = stats.tolist()
+            self.record_means[learn.epoch] = {'means': (mean_mean, mean_min, mean_max),
+                                              'stds': (std_mean, std_min, std_max)}
 
             print(f'init stats values: Epoch {learn.epoch}: Means: (mean={mean_mean:.2f}, min={mean_min:.2f}, max={mean_max:.2f}), ' +
                   f'Stds: (mean={std_mean:.2f}, min={std_min:.2f}, max={std_max:.2f}')
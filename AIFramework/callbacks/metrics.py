@@ -1,9 +1,124 @@
-from copy import copy
+from copy import copy, deepcopy
+import time
+import numpy as np
+import torch
 import fastcore.all as fc
-from torcheval.metrics import MulticlassAccuracy, Mean
-from fastprogress import progress_bar, master_bar
+import torch.distributed as dist
 from .callbacks import Callback
-from .utils import to_cpu
+from .utils import to_cpu, in_notebook, is_distributed, is_main_process, GrowableArray
+
+
+class DeviceMetric():
+    """Base class for metrics accumulated as running tensors on the device of the inputs.
+    Sample counts are kept on the host, so updating never syncs: the host is reached only by compute().
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.state = None
+        self.count = 0
+        return self
+
+    def to(self, device):
+        if self.state is not None:
+            self.state = [s.to(device) for s in self.state]
+        return self
+
+    def reduced(self):
+        ''' copy of the metric with states and counts summed across the torch.distributed processes '''
+        m = copy(self)
+        m.state = [s.clone() for s in self.state]
+        for s in m.state:
+            dist.all_reduce(s)
+        count = torch.tensor(float(self.count), device=m.state[0].device)
+        dist.all_reduce(count)
+        m.count = count.item()
+        return m
+
+    def _accumulate(self, *values):
+        if self.state is None:
+            self.state = [v.detach().clone() for v in values]
+        else:
+            for s, v in zip(self.state, values):
+                s.add_(v.detach())
+
+
+class DeviceMean(DeviceMetric):
+    """Weighted mean, same semantics of torcheval Mean
+    """
+
+    def update(self, input, weight=1.0):
+        input = input.detach().float()
+        if isinstance(weight, torch.Tensor):
+            weight = weight.detach().float()
+            self._accumulate((input * weight).sum(), weight.sum())
+        else:
+            self._accumulate(input.sum() * weight, input.new_zeros(()))
+            self.count += weight * input.numel()
+        return self
+
+    def compute(self):
+        if self.state is None:
+            return torch.tensor(0.)
+        total, weight = self.state
+        return total / (weight + self.count)
+
+
+class DeviceAccuracy(DeviceMetric):
+    """Micro averaged multiclass accuracy, same semantics of torcheval MulticlassAccuracy
+    """
+
+    def update(self, input, target):
+        if input.ndim == target.ndim + 1:
+            input = input.argmax(dim=-1)
+        self._accumulate((input == target).sum())
+        self.count += target.numel()
+        return self
+
+    def compute(self):
+        if self.state is None:
+            return torch.tensor(0.)
+        return self.state[0].float() / self.count
+
+
+class DeviceConfusionMatrix(DeviceMetric):
+    """Multiclass confusion matrix (rows are targets, columns are predictions)
+    """
+
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        super().__init__()
+
+    def update(self, input, target):
+        if input.ndim == target.ndim + 1:
+            input = input.argmax(dim=-1)
+        n = self.num_classes
+        idx = target.reshape(-1).long() * n + input.reshape(-1).long()
+        self._accumulate(torch.bincount(idx, minlength=n*n).view(n, n))
+        self.count += target.numel()
+        return self
+
+    def compute(self):
+        if self.state is None:
+            return torch.zeros(self.num_classes, self.num_classes, dtype=torch.long)
+        return self.state[0]
+
+
+def sync_compute(m):
+    ''' compute of the metric, with its state reduced across the processes when training is distributed '''
+    if not is_distributed():
+        return m.compute()
+    if isinstance(m, DeviceMetric):
+        return m.reduced().compute()
+    from torcheval.metrics.toolkit import sync_and_compute
+    return sync_and_compute(m)
+
+
+def _fmt(v):
+    return f'{v:.3f}' if v.numel() == 1 else v.tolist()
+
 
 # print metrics with Progress bar
 
@@ -12,56 +127,128 @@ class MetricsCB(Callback):
     """This callback computes the metrics.
     """
 
-    def __init__(self, *ms, **metrics):
+    def __init__(self, *ms, on_device=False, sync_every=None, sink=None, **metrics):
         """
+        Args:
+            on_device (bool, optional): accumulate metrics on the learner device, without copying batches to cpu.
+                The host is synced only in after_epoch. Use DeviceAccuracy, DeviceMean, DeviceConfusionMatrix
+                (or any metric supporting .to(device)). Defaults to False.
+            sync_every (int, optional): with on_device, also sync the running values to self.values
+                every sync_every batches. Defaults to None.
+            sink (MetricsSink, optional): write the numeric values of every epoch to the sink (stream 'epoch')
+                instead of printing them. Defaults to None.
+
+        self.values holds the host values computed at the end of the last epoch.
         """
         for o in ms:
             metrics[type(o).__name__] = o
+        self.on_device, self.sync_every, self.sink = on_device, sync_every, sink
         self.metrics = metrics
         self.all_metrics = copy(metrics)
-        self.all_metrics['loss'] = self.loss = Mean()
+        if on_device:
+            self.loss = DeviceMean()
+        else:
+            from torcheval.metrics import Mean
+            self.loss = Mean()
+        self.all_metrics['loss'] = self.loss
+        self.values = {}
+        # a set of metrics for every phase, a validation in the middle of a training epoch doesn't reset them
+        valid = deepcopy(self.all_metrics)
+        self.phases = {True: (self.metrics, self.loss, self.all_metrics),
+                       False: ({k: valid[k] for k in metrics}, valid['loss'], valid)}
 
     def _log(self, d):
-        print(d)
+        if self.sink is None:
+            print(d)
 
     def before_fit(self, learn):
         learn.metrics = self
 
+    def _phase(self, learn):
+        self.metrics, self.loss, self.all_metrics = self.phases[learn.training]
+
     def before_epoch(self, learn):
+        self._phase(learn)
         [o.reset() for o in self.all_metrics.values()]
+        self.device = None
 
     def after_epoch(self, learn):
-        log = {k: f'{v.compute():.3f}' for k, v in self.all_metrics.items()}
+        self._phase(learn)
+        computed = {k: sync_compute(v) for k, v in self.all_metrics.items()}
+        self.values = {k: v.tolist() for k, v in computed.items()}
+        log = {k: _fmt(v) for k, v in computed.items()}
         log['epoch'] = learn.epoch
         log['train'] = 'train' if learn.model.training else 'eval'
-        self._log(log)
+        if is_main_process():  # only rank 0 logs in distributed training
+            if self.sink is not None:
+                self.sink.write('epoch', {'epoch': learn.epoch, 'train': learn.model.training, **self.values})
+            self._log(log)
 
     def after_batch(self, learn):
-        x, y, *_ = to_cpu(learn.batch)
+        self._phase(learn)
+        if self.on_device:
+            self._update_on_device(learn)
+        else:
+            x, y, *_ = to_cpu(learn.batch)
+            for m in self.metrics.values():
+                m.update(to_cpu(learn.preds), y)
+            self.loss.update(to_cpu(learn.loss), weight=len(x))
+
+    def _update_on_device(self, learn):
+        x, y, *_ = learn.batch
+        preds = learn.preds.detach()
+        if self.device is None:
+            self.device = preds.device
+            [o.to(self.device) for o in self.all_metrics.values()]
         for m in self.metrics.values():
-            m.update(to_cpu(learn.preds), y)
-        self.loss.update(to_cpu(learn.loss), weight=len(x))
+            m.update(preds, y)
+        self.loss.update(learn.loss.detach(), weight=len(x))
+        if self.sync_every and (learn.iter + 1) % self.sync_every == 0:
+            self.values = {k: v.compute().tolist() for k, v in self.all_metrics.items()}
 
 
 class ProgressCB(Callback):
     """This callback prints the progress of the training.
+    The loss is read (forcing a device sync) only when it's sampled,
+    every `every` batches or at most once every `every_ms` milliseconds.
     """
     order = MetricsCB.order+1
+    _timings = ('epoch_start', 'last_time', 'last_sample', 'epoch_samples', 'samples', 'batches')
+
+    headless_every_ms = 1000  # default interval of the lines printed when headless
 
-    def __init__(self, plot=True):
+    def __init__(self, plot=True, every=None, every_ms=None, headless=None):
         """
         Args:
             plot (bool, optional): if setted plot result in an hystogram. Defaults to True.
+            every (int, optional): sample the loss and redraw every `every` batches.
+                Defaults to None (every batch, or every headless_every_ms milliseconds when headless).
+            every_ms (float, optional): if setted, sample the loss at most once every `every_ms` milliseconds,
+                instead of every `every` batches. Defaults to None.
+            headless (bool, optional): don't draw progress bars and graphs, print throughput lines only
+                (samples/sec and ms/batch). Defaults to None, headless when not running in a notebook.
         """
-        self.plot = plot
+        self.headless = not in_notebook() if headless is None else headless
+        if every is None and every_ms is None and self.headless:
+            every_ms = self.headless_every_ms  # a printed line per batch would flood the logs
+        self.plot, self.every, self.every_ms = plot, every or 1, every_ms
 
     def before_fit(self, learn):
-        learn.epochs = self.mbar = master_bar(learn.epochs)
+        self.mbar = None
+        self.silent = not is_main_process()  # only rank 0 shows the progress in distributed training
+        if self.silent:
+            return
+        if not self.headless:
+            from fastprogress import master_bar
+            learn.epochs = self.mbar = master_bar(learn.epochs)
+            if hasattr(learn, 'metrics'):
+                learn.metrics._log = self._log
         self.first = True
-        if hasattr(learn, 'metrics'):
-            learn.metrics._log = self._log
-        self.losses = []
-        self.val_losses = []
+        self.train_iter = 0  # training batches seen, it's the x of the loss graph
+        self.loss_iters = GrowableArray(dtype=np.int64)
+        self.losses = GrowableArray()
+        self.val_losses, self.val_iters = [], []  # val_iters: training batches seen at every validation
+        self.paused, self.training_epoch = None, False
 
     def _log(self, d):
         if self.first:
@@ -70,25 +257,91 @@ class ProgressCB(Callback):
         self.mbar.write(list(d.values()), table=True)
 
     def before_epoch(self, learn):
-        learn.dl = progress_bar(learn.dl, leave=False, parent=self.mbar)
+        if self.silent:
+            return
+        if not learn.training and self.training_epoch:
+            # validation in the middle of a training epoch, its timings are paused
+            self.paused = time.perf_counter(), {k: getattr(self, k) for k in self._timings}
+        self.training_epoch = learn.training
+        if not self.headless:
+            from fastprogress import progress_bar
+            learn.dl = progress_bar(learn.dl, leave=False, parent=self.mbar)
+        self.epoch_start = self.last_time = self.last_sample = time.perf_counter()
+        self.epoch_samples = self.samples = self.batches = 0
+
+    def _sample(self, learn):
+        if self.every_ms is not None:
+            now = time.perf_counter()
+            if (now - self.last_sample) * 1000 < self.every_ms:
+                return False
+            self.last_sample = now
+            return True
+        return (learn.iter + 1) % self.every == 0
 
     def after_batch(self, learn):
-        learn.dl.comment = f'{learn.loss:.3f}'
+        if self.silent:
+            return
+        if getattr(learn, 'warmup', False):
+            # compilation warmup batch, left out of the throughput
+            self.epoch_start = self.last_time = time.perf_counter()
+            return
+        n = len(learn.batch[0])
+        self.samples += n
+        self.epoch_samples += n
+        self.batches += 1
+        if learn.training:
+            self.train_iter += 1
+        if not self._sample(learn):
+            return
+        loss = learn.loss.item()
+        if self.headless:
+            self._print_throughput(learn, loss)
+            return
+        learn.dl.comment = f'{loss:.3f}'
         if self.plot and hasattr(learn, 'metrics') and learn.training:
-            self.losses.append(learn.loss.item())
+            self.loss_iters.append(self.train_iter - 1)
+            self.losses.append(loss)
             if self.val_losses:
-                self.mbar.update_graph([
-                    [fc.L.range(self.losses), self.losses], [fc.L.range(learn.epoch).map(
-                        lambda x: (x+1)*len(learn.dataloaders.train)), self.val_losses]
-                ])
+                self._update_graph(learn)
+
+    def _print_throughput(self, learn, loss):
+        now = time.perf_counter()
+        elapsed, self.last_time = now - self.last_time, now
+        phase = 'train' if learn.training else 'eval'
+        print(f'epoch {learn.epoch} {phase} batch {learn.iter+1}/{len(learn.dl)}: loss {loss:.3f}, '
+              f'{self.samples / elapsed:.1f} samples/sec, {elapsed * 1000 / self.batches:.2f} ms/batch')
+        self.samples = self.batches = 0
+
+    def _update_graph(self, learn):
+        self.mbar.update_graph([[self.loss_iters.data, self.losses.data], [self.val_iters, self.val_losses]])
 
     def after_epoch(self, learn):
+        if self.silent:
+            return
+        if self.headless:
+            elapsed = time.perf_counter() - self.epoch_start
+            phase = 'train' if learn.training else 'eval'
+            print(f'epoch {learn.epoch} {phase}: {elapsed:.1f}s, {self.epoch_samples / elapsed:.1f} samples/sec')
+            return
         if not learn.training:
             if self.plot and hasattr(learn, 'metrics'):
-                self.val_losses.append(
-                    learn.metrics.all_metrics['loss'].compute())
-                self.mbar.update_graph([[fc.L.range(self.losses), self.losses], [fc.L.range(
-                    learn.epoch+1).map(lambda x: (x+1)*len(learn.dataloaders.train)), self.val_losses]])
+                self.val_losses.append(learn.metrics.values['loss'])
+                self.val_iters.append(self.train_iter)
+                self._update_graph(learn)
+
+    def cleanup_epoch(self, learn):
+        if self.silent:
+            return
+        if learn.training:
+            self.training_epoch = False
+        elif self.paused is not None:
+            # back to the training epoch, the validation time is left out of its throughput
+            start, timings = self.paused
+            self.__dict__.update(timings)
+            pause = time.perf_counter() - start
+            self.epoch_start, self.last_time, self.last_sample = (
+                self.epoch_start + pause, self.last_time + pause, self.last_sample + pause)
+            self.paused = None
 
 
 def get_metrics_cb():
@@ -96,17 +349,21 @@ def get_metrics_cb():
     Returns:
         MetricsCB: a metricCB callback instance
     """
+    from torcheval.metrics import MulticlassAccuracy
     metrics = MetricsCB(accuracy=MulticlassAccuracy())
     return metrics
 
 
-def get_progress_cb(plot=True):
+def get_progress_cb(plot=True, every=None, every_ms=None, headless=None):
     """ Helper function to instantiate ProgressCB callback
 
     Args:
         plot (bool): if setted plot result in an hystogram, True by default
+        every (int): sample the loss every `every` batches, None by default (see ProgressCB)
+        every_ms (float): sample the loss at most once every `every_ms` milliseconds, None by default
+        headless (bool): print throughput lines only, None by default (headless outside notebooks)
 
     Returns:
         ProgressCB: a ProgressCB Callback instance
     """
-    return ProgressCB(plot)
+    return ProgressCB(plot, every, every_ms, headless)
@@ -80,12 +80,18 @@ def get_grid(
     return fig, axs
 
 
+def _hists(h):
+    if isinstance(h.stats, tuple):  # list based stats
+        return torch.stack(h.stats[2])
+    return torch.from_numpy(h.stats.hists)  # HookStats view, no copies
+
+
 def get_hist(h):
-    return torch.stack(h.stats[2]).t().float().log1p()
+    return _hists(h).t().float().log1p()
 
 
 def get_min(h):
-    h1 = torch.stack(h.stats[2]).t().float()
+    h1 = _hists(h).t().float()
     return h1[0]/h1.sum(0)
 
 
@@ -1,31 +1,114 @@
-from matplotlib import pyplot as plt
+import os
+import numpy as np
 import fastcore.all as fc
 from .callbacks import HooksCallback, Hooks, SingleBatchCB
-from .plotCharts.utils import get_grid, show_image, get_hist, get_min
-from .utils import to_cpu
+from .utils import GrowableArray
 import torch
 
 
+class HookStats():
+    """Array backed store of the activation statistics collected by a hook.
+    Every row holds mean, std and the histogram of a batch, rows are preallocated in chunks
+    and optionally memory mapped on disk. means, stds and hists are views, they are never stacked again.
+
+    stats[0], stats[1], stats[2] return means, stds and hists as the list based stats did.
+    """
+
+    def __init__(self, n_bins=40, capacity=1024, path=None, max_len=None):
+        """
+        Args:
+            n_bins (int, optional): histogram bins. Defaults to 40.
+            capacity (int, optional): rows initially allocated. Defaults to 1024.
+            path (str, optional): file used to spill the rows on disk. Defaults to None (in memory).
+            max_len (int, optional): when the store reaches max_len rows, the old rows are downsampled
+                averaging them in pairs, so from then on every row summarizes `stride` batches. Defaults to None.
+        """
+        self.n_bins, self.max_len = n_bins, max_len
+        self.rows = GrowableArray((n_bins+2,), capacity=capacity, path=path)
+        self.stride = 1
+        self._acc, self._n_acc = np.zeros(n_bins+2, dtype=np.float32), 0
+
+    def append(self, row):
+        if self.stride == 1:
+            self.rows.append(row)
+        else:
+            self._acc += row
+            self._n_acc += 1
+            if self._n_acc < self.stride:
+                return
+            self.rows.append(self._acc / self.stride)
+            self._acc[:], self._n_acc = 0, 0
+        if self.max_len and len(self.rows) >= self.max_len:
+            self._downsample()
+
+    def _downsample(self):
+        d = self.rows.data
+        m = len(d) // 2
+        if len(d) % 2:
+            # the odd row is the first part of the next one
+            self._acc[:], self._n_acc = d[2*m] * self.stride, self.stride
+        d[:m] = (d[0:2*m:2] + d[1:2*m:2]) / 2
+        self.rows.n = m
+        self.stride *= 2
+
+    @property
+    def means(self):
+        return self.rows.data[:, 0]
+
+    @property
+    def stds(self):
+        return self.rows.data[:, 1]
+
+    @property
+    def hists(self):
+        return self.rows.data[:, 2:]
+
+    @property
+    def batches(self):
+        return np.arange(len(self.rows)) * self.stride
+
+    def __getitem__(self, i):
+        return (self.means, self.stds, self.hists)[i]
+
+    def __len__(self):
+        return len(self.rows)
+
+
 def append_stats(hook, mod, inp, outp):
     if not hasattr(hook, 'stats'):
-        hook.stats = ([], [], [])
-    acts = to_cpu(outp)
+        hook.stats = HookStats()
+    # reduce on the activations device, then copy to cpu only mean, std and the 40 bins histogram
+    acts = outp.detach().float()
+    stats = torch.cat([torch.stack([acts.mean(), acts.std()]), acts.abs().histc(40, 0, 10)])
     hook.mod = mod
-    hook.stats[0].append(acts.mean())
-    hook.stats[1].append(acts.std())
-    hook.stats[2].append(acts.abs().histc(40, 0, 10))
+    hook.stats.append(stats.cpu().numpy())
 
 
 class ActivationStats(HooksCallback):
     """Callback to collect and plotting activation statistics
     """
 
-    def __init__(self, mod_filter=fc.noop):
+    def __init__(self, mod_filter=fc.noop, mods=None, every=1, on_valid=False, capacity=1024, spill_dir=None, max_len=None):
         """
         Args:
             mod_filter (fn, optional): . Defaults to fc.noop.
+            mods (list, optional): subset of modules to hook, instead of filtering all the model modules. Defaults to None.
+            every (int, optional): collect stats every `every` batches only. Defaults to 1.
+            on_valid (bool, optional): collect stats during validation too. Defaults to False.
+            capacity (int, optional): stats rows initially allocated for every hook. Defaults to 1024.
+            spill_dir (str, optional): directory where the stats of every hook are memory mapped. Defaults to None.
+            max_len (int, optional): rows kept for every hook before downsampling the old ones. Defaults to None.
         """
-        super().__init__(append_stats, mod_filter)
+        super().__init__(append_stats, mod_filter, on_valid=on_valid, mods=mods, every=every)
+        self.capacity, self.spill_dir, self.max_len = capacity, spill_dir, max_len
+
+    def before_fit(self, learn):
+        super().before_fit(learn)
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        for i, h in enumerate(self.hooks):
+            path = None if self.spill_dir is None else os.path.join(self.spill_dir, f'hook_{i}.stats')
+            h.stats = HookStats(capacity=self.capacity, path=path, max_len=self.max_len)
 
     def color_dim(self, figsize=(20, 5)):
         """plots neurons activation
@@ -33,6 +116,7 @@ class ActivationStats(HooksCallback):
         Args:
             figsize (tuple, optional): _description_. Defaults to (20, 5).
         """
+        from .plotCharts.utils import get_grid, show_image, get_hist
         fig, axes = get_grid(len(self), figsize=figsize)
         index = 0
         for ax, h in zip(axes.flat, self):
@@ -49,6 +133,7 @@ class ActivationStats(HooksCallback):
         Args:
             figsize (tuple, optional): _description_. Defaults to (11, 9).
         """
+        from .plotCharts.utils import get_grid, get_min
         fig, axes = get_grid(len(self), figsize=figsize)
         for ax, h in zip(axes.flatten(), self):
             ax.plot(get_min(h))
@@ -64,17 +149,12 @@ class ActivationStats(HooksCallback):
         Args:
             figsize (tuple, optional): _description_. Defaults to (10, 4).
         """
+        from matplotlib import pyplot as plt
         fig, axs = plt.subplots(1, 2, figsize=figsize)
         legends = []
         for index, h in enumerate(self):
             for i in 0, 1:
-                values = h.stats[i]
-
-                # convert to numpy array because numpy doesn't supports bf16 format, if not f32
-                if values[0].dtype is torch.bfloat16:
-                    values = [v.float().numpy() for v in values]
-                
-                axs[i].plot(values)
+                axs[i].plot(h.stats.batches, h.stats[i])
             title = f'{index} {h.mod._get_name()}'
             if hasattr(h.mod, 'in_channels'):
                 title = f'{title} ({h.mod.in_channels}, {h.mod.out_channels})'
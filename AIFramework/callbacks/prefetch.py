@@ -0,0 +1,171 @@
+import time
+import queue
+import threading
+from functools import partial
+from operator import attrgetter
+from typing import Mapping
+import torch
+from .callbacks import Callback
+from .device import DeviceCB, pin_memory
+
+__all__ = ['Prefetcher', 'PrefetchCB']
+
+
+class _Error():
+    def __init__(self, exc):
+        self.exc = exc
+
+
+_END = object()
+
+
+def _record_stream(x, stream):
+    # batches created on the copy stream are used on the compute stream
+    if isinstance(x, torch.Tensor):
+        if x.is_cuda:
+            x.record_stream(stream)
+    elif isinstance(x, Mapping):
+        for v in x.values():
+            _record_stream(v, stream)
+    elif isinstance(x, (list, tuple)):
+        for o in x:
+            _record_stream(o, stream)
+
+
+class Prefetcher():
+    """Iterates a dataloader in a background thread, applying the batch transforms
+    to the next n batches while the training loop computes the current one.
+
+    With an accelerator device the batches are pinned and the transforms run on a side stream,
+    so the host to device copies are asynchronous and overlap with compute.
+    wait_time is the time the training loop waited for the batches.
+    """
+
+    def __init__(self, dl, tfms, n=2, device=None, pin=True):
+        """
+        Args:
+            dl (iterable): the dataloader
+            tfms (list): functions applied in order to every batch
+            n (int, optional): batches prepared in advance. Defaults to 2.
+            device (str, optional): device where the transforms move the batches. Defaults to None.
+            pin (bool, optional): pin the batches before transforming them, if device is an accelerator. Defaults to True.
+        """
+        self.dl, self.tfms, self.n = dl, tfms, n
+        cuda = device is not None and torch.device(device).type == 'cuda' and torch.cuda.is_available()
+        self.pin = pin and cuda
+        self.stream = torch.cuda.Stream(device) if cuda else None
+        self.wait_time = 0.
+        self._thread = None
+
+    def __len__(self):
+        return len(self.dl)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _prepare(self, batch):
+        if self.pin:
+            batch = pin_memory(batch)
+        for tfm in self.tfms:
+            batch = tfm(batch)
+        return batch
+
+    def _worker(self):
+        try:
+            for batch in self.dl:
+                if self.stream is None:
+                    item = self._prepare(batch), None
+                else:
+                    with torch.cuda.stream(self.stream):
+                        batch = self._prepare(batch)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                    item = batch, event
+                if not self._put(item):
+                    return
+        except Exception as e:
+            self._put(_Error(e))
+            return
+        self._put(_END)
+
+    def __iter__(self):
+        self.close()
+        self._stop, self._queue = threading.Event(), queue.Queue(self.n)
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+        while True:
+            start = time.perf_counter()
+            item = self._queue.get()
+            self.wait_time += time.perf_counter() - start
+            if item is _END:
+                break
+            if isinstance(item, _Error):
+                raise item.exc
+            batch, event = item
+            if event is not None:
+                stream = torch.cuda.current_stream()
+                stream.wait_event(event)
+                _record_stream(batch, stream)
+            yield batch
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+
+class PrefetchCB(Callback):
+    """Runs the batch transforms of the callbacks exposing transform_batch (DeviceCB, BatchTransformCB)
+    in a background thread, for the next n batches, instead of running them in before_batch.
+
+    The time the training loop waited for data is stored in learn.data_wait_time after every epoch
+    and collected in self.wait_times.
+
+    example usage:
+    learn.fit(3, callbacks=[PrefetchCB(n=4)])
+    """
+    order = DeviceCB.order - 1  # learn.dl must be wrapped before ProgressCB wraps it
+
+    def __init__(self, n=2, pin_memory=True, verbose=False):
+        """
+        Args:
+            n (int, optional): batches prepared in advance. Defaults to 2.
+            pin_memory (bool, optional): pin the batches when moving them to an accelerator. Defaults to True.
+            verbose (bool, optional): print the data waiting time after every epoch. Defaults to False.
+        """
+        self.n, self.pin_memory, self.verbose = n, pin_memory, verbose
+
+    def before_fit(self, learn):
+        self.tfm_cbs = [cb for cb in sorted(learn.callbacks, key=attrgetter('order')) if hasattr(cb, 'transform_batch')]
+        for cb in self.tfm_cbs:
+            cb.prefetched = True
+        devices = [cb.device for cb in self.tfm_cbs if isinstance(cb, DeviceCB)]
+        self.device = devices[-1] if devices else None
+        self.prefetchers, self.wait_times = [], []
+
+    def before_epoch(self, learn):
+        tfms = [partial(cb.transform_batch, training=learn.training) for cb in self.tfm_cbs]
+        learn.dl = Prefetcher(learn.dl, tfms, self.n, self.device, self.pin_memory)
+        self.prefetchers.append(learn.dl)
+
+    def cleanup_epoch(self, learn):
+        if not self.prefetchers:
+            return
+        prefetcher = self.prefetchers.pop()
+        prefetcher.close()
+        learn.data_wait_time = prefetcher.wait_time
+        phase = 'train' if learn.training else 'eval'
+        self.wait_times.append({'epoch': learn.epoch, 'train': phase, 'wait': prefetcher.wait_time})
+        if self.verbose:
+            print(f'epoch {learn.epoch} {phase}: waited {prefetcher.wait_time:.3f}s for data')
+
+    def cleanup_fit(self, learn):
+        for cb in self.tfm_cbs:
+            cb.prefetched = False
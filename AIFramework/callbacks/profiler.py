@@ -0,0 +1,138 @@
+import os
+import json
+import time
+from collections import defaultdict
+import torch
+from .callbacks import Callback
+
+__all__ = ['ProfilerCB']
+
+
+class ProfilerCB(Callback):
+    """Records the wall time of every event and of every callback method, for one batch every `every`.
+    Batches that are not sampled run the plain Learner dispatch, so it's cheap enough to be left on.
+    The time between two batches is recorded as the 'data' event (waiting for the dataloader).
+
+    Optionally wraps torch.profiler for a window of batches.
+    After fit learn.profiler.summary() prints a table and export_chrome_trace(path)
+    writes the sampled events for chrome://tracing or https://ui.perfetto.dev
+
+    example usage:
+    learn.fit(1, callbacks=[ProfilerCB(every=100, trace_path='trace.json')])
+    """
+    order = 1000  # the last one in cleanup_batch, it measures the whole batch
+
+    def __init__(self, every=100, torch_window=None, torch_trace_path=None, trace_path=None, verbose=True):
+        """
+        Args:
+            every (int, optional): profile one batch every `every` batches. Defaults to 100.
+            torch_window (tuple, optional): (first batch, number of batches) profiled with torch.profiler. Defaults to None.
+            torch_trace_path (str, optional): chrome trace file of the torch.profiler window. Defaults to None.
+            trace_path (str, optional): chrome trace file of the sampled events, written after fit. Defaults to None.
+            verbose (bool, optional): print the summary table after fit. Defaults to True.
+        """
+        self.every, self.torch_window, self.torch_trace_path = every, torch_window, torch_trace_path
+        self.trace_path, self.verbose = trace_path, verbose
+        self.active = False
+
+    def before_fit(self, learn):
+        learn.profiler = self
+        self.times, self.calls = defaultdict(float), defaultdict(int)
+        self.trace = []
+        self.n_batches = self.n_sampled = 0
+        self.batch_time = 0.
+        self.batch_end = None
+        self.prof = None
+        self.start = time.perf_counter()
+        self.active = True
+
+    def _record(self, name, cb, start, duration):
+        self.times[name, cb] += duration
+        self.calls[name, cb] += 1
+        self.trace.append((f'{cb}.{name}' if cb else name, start, duration))
+
+    def run(self, learn, event, methods):
+        ''' dispatches event to methods measuring them, it's called by the Learner for sampled batches '''
+        start = time.perf_counter()
+        if event == 'before_batch':
+            self.batch_start = start
+            if self.batch_end is not None:
+                self._record('data', '', self.batch_end, start - self.batch_end)
+        try:
+            for method in methods:
+                t = time.perf_counter()
+                try:
+                    method(learn)
+                finally:
+                    self._record(event, type(method.__self__).__name__, t, time.perf_counter() - t)
+        finally:
+            end = time.perf_counter()
+            self._record(event, '', start, end - start)
+            if event == 'cleanup_batch':
+                self._record('batch', '', self.batch_start, end - self.batch_start)
+                self.batch_time += end - self.batch_start
+                self.n_sampled += 1
+
+    def before_batch(self, learn):
+        if self.torch_window is not None and self.n_batches == self.torch_window[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.prof = torch.profiler.profile(activities=activities)
+            self.prof.__enter__()
+
+    def cleanup_batch(self, learn):
+        self.n_batches += 1
+        if self.prof is not None and self.n_batches == sum(self.torch_window):
+            self._stop_torch_profiler()
+        self.active = self.n_batches % self.every == 0
+        # the wait for the next batch is measured only if it's sampled
+        self.batch_end = time.perf_counter() if self.active else None
+
+    def _stop_torch_profiler(self):
+        self.prof.__exit__(None, None, None)
+        if self.torch_trace_path is not None:
+            self.prof.export_chrome_trace(self.torch_trace_path)
+        if self.verbose:
+            print(self.prof.key_averages().table(sort_by='self_cpu_time_total', row_limit=15))
+        self.prof = None
+
+    def cleanup_fit(self, learn):
+        self.active = False
+        learn.profiler = None
+        if self.prof is not None:
+            self._stop_torch_profiler()
+        if self.verbose:
+            self.summary()
+        if self.trace_path is not None:
+            self.export_chrome_trace(self.trace_path)
+
+    def summary(self, verbose=True):
+        """summary of the sampled events, sorted by total time
+
+        Args:
+            verbose (bool, optional): print the table. Defaults to True.
+
+        Returns:
+            list: a dict for every (event, callback), with calls, total and mean ms,
+                and the percentage of the sampled batches time
+        """
+        rows = []
+        for (event, cb), t in sorted(self.times.items(), key=lambda o: -o[1]):
+            n = self.calls[event, cb]
+            rows.append({'event': event, 'callback': cb or '*', 'calls': n, 'total_ms': t * 1000,
+                         'mean_ms': t * 1000 / n, 'batch_pct': 100 * t / self.batch_time if self.batch_time else 0.})
+        if verbose:
+            print(f'profiled {self.n_sampled} of {self.n_batches} batches')
+            print(f'{"event":<16} {"callback":<24} {"calls":>7} {"total ms":>10} {"mean ms":>9} {"% batch":>8}')
+            for r in rows:
+                print(f'{r["event"]:<16} {r["callback"]:<24} {r["calls"]:>7} {r["total_ms"]:>10.2f} '
+                      f'{r["mean_ms"]:>9.3f} {r["batch_pct"]:>8.1f}')
+        return rows
+
+    def export_chrome_trace(self, path):
+        events = [{'name': name, 'cat': 'learner', 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                   'ts': (start - self.start) * 1e6, 'dur': duration * 1e6}
+                  for name, start, duration in self.trace]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events}, f)
@@ -1,5 +1,4 @@
 from .callbacks import Callback
-from matplotlib import pyplot as plt
 from .utilities import AccelerateCB
 
 
@@ -22,11 +21,13 @@ class BaseSchedCB(Callback):
 
 class BatchSchedCB(BaseSchedCB):
     """
-    This callback executes the scheduler after every batch.
+    This callback executes the scheduler after every optimizer step
+    (after every batch, or every learn.grad_accum batches).
     """
 
     def after_batch(self, learn):
-        self._step(learn)
+        if learn.stepped:
+            self._step(learn)
 
 
 class EpochSchedCB(BaseSchedCB):
@@ -56,11 +57,12 @@ class RecorderCB(Callback):
 
     example usage:
     rec = RecorderCB(lr=_lr)
+    rec = RecorderCB(lr=_lr, sink=MetricsSink('logs')) # also writes the values to the sink (stream 'recorder')
     """
     order = AccelerateCB.order+1 # to use correct scheduler if acccelerateCB is setted
 
-    def __init__(self, **d):
-        self.d = d
+    def __init__(self, sink=None, **d):
+        self.d, self.sink = d, sink
 
     def before_fit(self, learn):
         self.recs = {k:
@@ -68,12 +70,16 @@ class RecorderCB(Callback):
         self.pg = learn.opt.param_groups[0] # monitor torch scheduler first param_groups only
 
     def after_batch(self, learn):
-        if not learn.training:
+        if not learn.training or not learn.stepped:
             return
         for k, v in self.d.items():
             self.recs[k].append(v(self))
+        if self.sink is not None:
+            self.sink.write('recorder', {'epoch': learn.epoch, 'iter': learn.iter,
+                                         **{k: v[-1] for k, v in self.recs.items()}})
 
     def plot(self):
+        from matplotlib import pyplot as plt
         for k, v in self.recs.items():
             plt.plot(v, label=k)
             plt.legend()
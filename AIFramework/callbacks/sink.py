@@ -0,0 +1,210 @@
+import os
+import csv
+import json
+import time
+import threading
+import numpy as np
+import torch
+from .callbacks import Callback
+
+__all__ = ['MetricsSink', 'read_log', 'SinkCB']
+
+
+def _to_py(v):
+    if isinstance(v, torch.Tensor):
+        return v.item() if v.numel() == 1 else v.tolist()  # device tensors are synced in the writer thread
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+class _Columns():
+    ''' rows buffered as one list per column, rows missing a column hold None '''
+
+    def __init__(self):
+        self.cols, self.n = {}, 0
+
+    def add(self, record):
+        for k in record:
+            if k not in self.cols:
+                self.cols[k] = [None] * self.n
+        for k, col in self.cols.items():
+            col.append(record.get(k))
+        self.n += 1
+
+
+class MetricsSink():
+    """Buffered sink of numeric records (metrics, loss, lr, throughput, memory), grouped in named streams.
+    Records are buffered in columns and a background thread writes them in batches,
+    every flush_every records or flush_secs seconds, so writing a record never blocks on disk.
+    Tensors are converted to numbers by the writer thread.
+
+    Every stream is written in path/<stream>.<format>, read them back with read_log(path, stream).
+    Formats: 'jsonl', 'csv' (columns of the first flush), 'npz' (a file for every flush).
+
+    example usage:
+    sink = MetricsSink('logs/run1')
+    learn.fit(10, callbacks=[MetricsCB(accuracy=MulticlassAccuracy(), sink=sink), SinkCB(sink)])
+    sink.close()
+    read_log('logs/run1', 'epoch')
+    """
+
+    def __init__(self, path, format='jsonl', flush_every=1024, flush_secs=5.):
+        """
+        Args:
+            path (str): directory of the log files
+            format (str, optional): 'jsonl', 'csv' or 'npz'. Defaults to 'jsonl'.
+            flush_every (int, optional): buffered records that trigger a write. Defaults to 1024.
+            flush_secs (float, optional): max seconds a record stays in the buffer. Defaults to 5.
+        """
+        assert format in ('jsonl', 'csv', 'npz'), f'unknown format {format}'
+        self.path, self.format, self.flush_every, self.flush_secs = path, format, flush_every, flush_secs
+        os.makedirs(path, exist_ok=True)
+        self.buffers, self.n_buffered = {}, 0
+        self.csv_cols, self.n_parts = {}, {}
+        self.lock, self.wake = threading.Lock(), threading.Event()
+        self.written = threading.Condition(self.lock)  # notified after every write
+        self.n_records, self.n_written = 0, 0  # records enqueued and written, flush waits for them
+        self.closed = False
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def write(self, stream, record):
+        with self.lock:
+            self.buffers.setdefault(stream, _Columns()).add(record)
+            self.n_buffered += 1
+            self.n_records += 1
+            if self.n_buffered >= self.flush_every:
+                self.wake.set()
+
+    def _writer(self):
+        while True:
+            self.wake.wait(self.flush_secs)
+            self.wake.clear()
+            with self.lock:
+                buffers, self.buffers, self.n_buffered = self.buffers, {}, 0
+                closed, n_records = self.closed, self.n_records
+            for stream, columns in buffers.items():
+                try:
+                    self._write(stream, {k: [_to_py(v) for v in col] for k, col in columns.cols.items()}, columns.n)
+                except Exception as e:
+                    print(f'metrics sink write failed: {e}')
+            with self.written:
+                self.n_written = n_records
+                self.written.notify_all()
+            if closed:
+                return
+
+    def _file(self, stream, ext=None):
+        return os.path.join(self.path, f'{stream}.{ext or self.format}')
+
+    def _write(self, stream, cols, n):
+        if self.format == 'jsonl':
+            with open(self._file(stream), 'a') as f:
+                for i in range(n):
+                    f.write(json.dumps({k: col[i] for k, col in cols.items()}) + '\n')
+        elif self.format == 'csv':
+            new = stream not in self.csv_cols
+            names = self.csv_cols.setdefault(stream, list(cols))  # columns fixed by the first flush
+            with open(self._file(stream), 'a', newline='') as f:
+                w = csv.writer(f)
+                if new:
+                    w.writerow(names)
+                for i in range(n):
+                    w.writerow(['' if k not in cols or cols[k][i] is None else cols[k][i] for k in names])
+        else:
+            part = self.n_parts.get(stream, 0)
+            self.n_parts[stream] = part + 1
+            arrays = {k: np.array([np.nan if v is None else v for v in col]) for k, col in cols.items()}
+            np.savez(self._file(stream, f'{part:05d}.npz'), **arrays)
+
+    def flush(self):
+        ''' writes the records buffered before the call and waits for it, after close it returns at once '''
+        with self.written:
+            n_records = self.n_records
+            self.wake.set()
+            # the writer thread exits after the final write of close
+            self.written.wait_for(lambda: self.n_written >= n_records or not self.thread.is_alive())
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.wake.set()
+        self.thread.join()
+
+
+def read_log(path, stream):
+    """reads back a stream written by MetricsSink as a pandas DataFrame
+
+    Args:
+        path (str): the sink directory
+        stream (str): stream name ('epoch', 'batch',..)
+
+    Returns:
+        pandas.DataFrame: a row for every record
+    """
+    import glob
+    import pandas as pd
+    base = os.path.join(path, stream)
+    if os.path.exists(f'{base}.jsonl'):
+        return pd.read_json(f'{base}.jsonl', lines=True)
+    if os.path.exists(f'{base}.csv'):
+        return pd.read_csv(f'{base}.csv')
+    parts = sorted(glob.glob(f'{base}.*.npz'))
+    return pd.concat([pd.DataFrame(dict(np.load(p))) for p in parts], ignore_index=True)
+
+
+class SinkCB(Callback):
+    """Writes per batch loss, lr, throughput and memory to a MetricsSink (stream 'batch'),
+    and the throughput of every epoch (stream 'throughput').
+    The loss is passed as a tensor, it's read by the writer thread, so no sync happens in the training loop.
+    """
+    order = 100
+
+    def __init__(self, sink, every=1):
+        """
+        Args:
+            sink (MetricsSink): the sink
+            every (int, optional): write every `every` batches. Defaults to 1.
+        """
+        self.sink, self.every = sink, every
+
+    def _memory_mb(self, learn):
+        param = next(learn.model.parameters(), None)
+        if param is not None and param.is_cuda:
+            return torch.cuda.memory_allocated(param.device) / 2**20
+        try:
+            import resource
+        except ImportError:  # unix only
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def before_epoch(self, learn):
+        self.epoch_start = self.last = time.perf_counter()
+        self.samples = self.epoch_samples = 0
+
+    def after_batch(self, learn):
+        n = len(learn.batch[0])
+        self.samples += n
+        self.epoch_samples += n
+        if (learn.iter + 1) % self.every:
+            return
+        now = time.perf_counter()
+        elapsed, self.last = now - self.last, now
+        opt = getattr(learn, 'opt', None)
+        self.sink.write('batch', {
+            'epoch': learn.epoch, 'iter': learn.iter, 'train': learn.training,
+            'loss': learn.loss.detach(),
+            'lr': opt.param_groups[0]['lr'] if opt is not None else None,
+            'samples_per_sec': self.samples / elapsed, 'ms_per_batch': elapsed * 1000 / self.every,
+            'memory_mb': self._memory_mb(learn),
+        })
+        self.samples = 0
+
+    def after_epoch(self, learn):
+        elapsed = time.perf_counter() - self.epoch_start
+        self.sink.write('throughput', {'epoch': learn.epoch, 'train': learn.training, 'secs': elapsed,
+                                       'samples_per_sec': self.epoch_samples / elapsed})
+
+    def cleanup_fit(self, learn):
+        self.sink.flush()
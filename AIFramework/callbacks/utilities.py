@@ -1,9 +1,10 @@
 from .callbacks import Callback, TrainCB
 from .device import DeviceCB
-from accelerate import Accelerator
 import fastcore.all as fc
+import os
 import sys
 import gc
+import time
 import traceback
 import torch
 
@@ -62,29 +63,78 @@ class CleanMemEnvironmentCB(Callback):
             print("clean mem failed!")
 
 
+def get_device_type(learn):
+    """device type ('cpu', 'cuda',..) of the training, taken from DeviceCB or from the model parameters
+    """
+    for cb in learn.callbacks:
+        if isinstance(cb, DeviceCB):
+            return torch.device(cb.device).type
+    param = next(learn.model.parameters(), None)
+    return 'cpu' if param is None else param.device.type
+
+
+def get_grad_scaler(device_type):
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device_type)
+    return torch.cuda.amp.GradScaler()
+
+
 class MixedPrecisionCB(TrainCB):
-    """Apply a pytorch GradScaler to scale precision from 32bit to 16bit
-    and back to 32bit. This can help reduce memory footprint and speed up cuda calcs
-    because Nvidia CUDA works faster with 16bit floats than 32bit floats.
+    """Apply autocast to run forward and loss in 16bit floats, it reduces memory footprint
+    and speeds up calcs on hardware faster with 16bit floats than 32bit floats.
+
+    The device is taken from DeviceCB, or from the model parameters.
+    By default float16 is used on accelerators, with a pytorch GradScaler to scale the loss,
+    and bfloat16 on cpu, where no scaler is needed because bfloat16 has the float32 exponent range.
     """
     order = DeviceCB.order+10
 
+    def __init__(self, n_inp=1, dtype=None, device_type=None, on_valid=True):
+        """
+        Args:
+            n_inp (int, optional): number of inputs. Defaults to 1.
+            dtype (torch.dtype, optional): torch.float16 or torch.bfloat16.
+                Defaults to None (float16 on accelerators, bfloat16 on cpu).
+            device_type (str, optional): autocast device type. Defaults to None (detected).
+            on_valid (bool, optional): autocast validation batches too. Defaults to True.
+        """
+        super().__init__(n_inp=n_inp)
+        self.dtype, self.device_type, self.on_valid = dtype, device_type, on_valid
+
     def before_fit(self, learn):
-        self.scaler = torch.cuda.amp.GradScaler()
+        self.fit_device_type = self.device_type or get_device_type(learn)
+        self.fit_dtype = self.dtype or (torch.bfloat16 if self.fit_device_type == 'cpu' else torch.float16)
+        self.scaler = learn.scaler = get_grad_scaler(self.fit_device_type) if self.fit_dtype == torch.float16 else None
+        self.autocast = None
 
     def before_batch(self, learn):
-        self.autocast = torch.autocast("cuda", dtype=torch.float16)
-        self.autocast.__enter__()
+        if learn.training or self.on_valid:
+            self.autocast = torch.autocast(self.fit_device_type, dtype=self.fit_dtype)
+            self.autocast.__enter__()
+
+    def _exit_autocast(self):
+        if self.autocast is not None:
+            self.autocast.__exit__(None, None, None)
+            self.autocast = None
 
     def after_loss(self, learn):
-        self.autocast.__exit__(None, None, None)
+        self._exit_autocast()
+
+    def cleanup_batch(self, learn):
+        self._exit_autocast()  # if predict or get_loss raised
 
     def backward(self, learn):
-        self.scaler.scale(learn.loss).backward()
+        if self.scaler is None:
+            learn.loss.backward()
+        else:
+            self.scaler.scale(learn.loss).backward()
 
     def step(self, learn):
-        self.scaler.step(learn.opt)
-        self.scaler.update()
+        if self.scaler is None:
+            learn.opt.step()
+        else:
+            self.scaler.step(learn.opt)
+            self.scaler.update()
 
 
 class AccelerateCB(TrainCB):
@@ -115,6 +165,7 @@ class AccelerateCB(TrainCB):
 
     def __init__(self, n_inp=1, mixed_precision=None):
         super().__init__(n_inp=n_inp)
+        from accelerate import Accelerator
         self.acc = Accelerator(mixed_precision=mixed_precision)
 
     def before_fit(self, learn):
@@ -128,6 +179,107 @@ class AccelerateCB(TrainCB):
         self.acc.backward(learn.loss)
 
 
+def _n_graphs():
+    # graphs compiled by dynamo in this process, it grows at every compilation and recompilation
+    from torch._dynamo.utils import counters
+    return counters['stats']['unique_graphs']
+
+
+class CompileCB(Callback):
+    """
+    Compile the model (and optionally the loss function) with torch.compile in before_fit.
+
+    The batches that compile the model are warmup batches: learn.warmup is True while they run
+    and their time is added to learn.compile_time, so ProgressCB leaves them out of the throughput.
+    They are the first batch of every (training mode, input shape) seen, like the last partial batch
+    or the first validation batch, and any batch during which dynamo recompiled (a new graph was captured).
+    Validation batches with input shapes never seen in training run the eager model, to not recompile.
+    After fit learn.model is the original module again.
+
+    example usage:
+    learn.fit(3, callbacks=[CompileCB(mode='max-autotune', cache_dir='/tmp/inductor')])
+    """
+    order = AccelerateCB.order+1  # compile the prepared model
+    _cache_env = ('TORCHINDUCTOR_CACHE_DIR', 'TORCHINDUCTOR_FX_GRAPH_CACHE')
+
+    def __init__(self, mode=None, backend='inductor', dynamic=None, fullgraph=False, compile_loss=False, cache_dir=None):
+        """
+        Args:
+            mode (str, optional): torch.compile mode ('default', 'reduce-overhead', 'max-autotune'). Defaults to None.
+            backend (str, optional): torch.compile backend. Defaults to 'inductor'.
+            dynamic (bool, optional): torch.compile dynamic shapes. Defaults to None.
+            fullgraph (bool, optional): torch.compile fullgraph. Defaults to False.
+            compile_loss (bool, optional): compile learn.loss_func too. Defaults to False.
+            cache_dir (str, optional): inductor cache directory, the compiled graphs are reused
+                across processes. It's set during the fits only. Defaults to None.
+        """
+        fc.store_attr()
+        self.compiled = None
+
+    def _compile(self, f):
+        return torch.compile(f, mode=self.mode, backend=self.backend, dynamic=self.dynamic, fullgraph=self.fullgraph)
+
+    def before_fit(self, learn):
+        self.env = None
+        if self.cache_dir is not None:
+            # inductor reads the cache location from the environment when it compiles, restored in cleanup_fit
+            self.env = {k: os.environ.get(k) for k in self._cache_env}
+            os.environ.update(TORCHINDUCTOR_CACHE_DIR=self.cache_dir, TORCHINDUCTOR_FX_GRAPH_CACHE='1')
+        self.model, self.loss_func = learn.model, learn.loss_func
+        # successive fits of the same model reuse the compiled one
+        if self.compiled is None or self.compiled._orig_mod is not learn.model:
+            self.compiled = self._compile(learn.model)
+            self.compiled_loss = self._compile(learn.loss_func) if self.compile_loss else learn.loss_func
+            self.shapes, self.warmed = set(), set()
+        learn.model, learn.loss_func = self.compiled, self.compiled_loss
+        learn.warmup, learn.compile_time = False, 0.
+
+    def before_batch(self, learn):
+        shape = tuple(getattr(learn.batch[0], 'shape', ()))
+        if learn.training:
+            self.shapes.add(shape)
+            eager = False
+        else:
+            eager = shape not in self.shapes
+        learn.model = self.model if eager else self.compiled
+        learn.loss_func = self.loss_func if eager else self.compiled_loss
+        key = learn.training, shape
+        if not eager and key not in self.warmed:  # compiles for this mode and shape
+            self.warmed.add(key)
+            learn.warmup = True
+        self.n_graphs, self.start = _n_graphs(), time.perf_counter()
+
+    def _recompiled(self, learn):
+        # read before ProgressCB.after_batch, a recompilation for other guards makes it a warmup batch too
+        if not learn.warmup and _n_graphs() != self.n_graphs:
+            learn.warmup = True
+
+    def after_loss(self, learn):
+        if not learn.training:
+            self._recompiled(learn)
+
+    def after_backward(self, learn):
+        self._recompiled(learn)
+
+    def after_batch(self, learn):
+        if learn.warmup:
+            learn.warmup = False
+            learn.compile_time += time.perf_counter() - self.start
+
+    def after_fit(self, learn):
+        learn.warmup = False
+        if learn.model is self.compiled:  # not already unwrapped, ex. by AccelerateCB
+            learn.model = self.model
+        learn.loss_func = self.loss_func
+
+    def cleanup_fit(self, learn):
+        for k, v in (self.env or {}).items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
 class AccelerateWithCustomLossFuncCB(AccelerateCB):
     """
     AccelerateCB to use Accelerate HuggingFace Framework 
@@ -1,4 +1,7 @@
+import numpy as np
 import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from typing import Mapping
 
 
@@ -11,3 +14,104 @@ def to_cpu(x):
         return tuple(to_cpu(list(x)))
     res = x.detach().cpu()
     return res.float() if res.dtype == torch.float16 else res
+
+
+def in_notebook():
+    ''' True when running inside a jupyter kernel '''
+    try:
+        from IPython import get_ipython
+    except ImportError:
+        return False
+    ip = get_ipython()
+    return ip is not None and 'IPKernelApp' in ip.config
+
+
+class GrowableArray():
+    """numpy array preallocated in chunks, doubling its capacity when it's full.
+    data is a view of the filled rows, it's never copied by reading it.
+    With a path the rows are stored in a memory mapped file, that is extended in place when it grows.
+    """
+
+    def __init__(self, shape=(), dtype=np.float32, capacity=1024, path=None):
+        """
+        Args:
+            shape (tuple, optional): shape of a single row. Defaults to () (scalars).
+            dtype (optional): numpy dtype. Defaults to np.float32.
+            capacity (int, optional): rows initially allocated. Defaults to 1024.
+            path (str, optional): file used to spill the rows on disk. Defaults to None (in memory).
+        """
+        self.shape, self.dtype, self.path = tuple(shape), dtype, path
+        self._buf = self._alloc(capacity)
+        self.n = 0
+
+    def _alloc(self, capacity):
+        if self.path is None:
+            return np.empty((capacity, *self.shape), dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode='w+', shape=(capacity, *self.shape))
+
+    def _grow(self, capacity):
+        if self.path is None:
+            buf = self._alloc(capacity)
+            buf[:self.n] = self._buf[:self.n]
+            self._buf = buf
+        else:
+            # numpy extends the file, rows already written stay where they are
+            self._buf.flush()
+            self._buf = np.memmap(self.path, dtype=self.dtype, mode='r+', shape=(capacity, *self.shape))
+
+    def append(self, v):
+        if self.n == len(self._buf):
+            self._grow(2 * len(self._buf))
+        self._buf[self.n] = v
+        self.n += 1
+
+    def clear(self):
+        self.n = 0
+
+    @property
+    def data(self):
+        return self._buf[:self.n]
+
+    def __len__(self):
+        return self.n
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def is_main_process():
+    ''' False on the processes of torch.distributed but the rank 0 one '''
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+
+def is_shuffled(sampler):
+    ''' True for samplers with a random order: RandomSampler and the ones with a shuffle attribute (DistributedSampler, BlockSampler) '''
+    return isinstance(sampler, RandomSampler) or bool(getattr(sampler, 'shuffle', False))
+
+
+def rebuild_dataloader(dl, **kwargs):
+    """new DataLoader with the same settings of dl, but the ones passed as kwargs
+
+    Args:
+        dl (DataLoader): the dataloader to copy, objects with a rebuild(**kwargs) method rebuild themselves
+        kwargs: DataLoader arguments to replace (dataset, batch_size, sampler, shuffle, num_workers,..)
+
+    Returns:
+        DataLoader: the new dataloader
+    """
+    if hasattr(dl, 'rebuild'):
+        return dl.rebuild(**kwargs)
+    params = dict(dataset=dl.dataset, batch_size=dl.batch_size, num_workers=dl.num_workers,
+                  collate_fn=dl.collate_fn, pin_memory=dl.pin_memory, drop_last=dl.drop_last,
+                  timeout=dl.timeout, worker_init_fn=dl.worker_init_fn, generator=dl.generator,
+                  persistent_workers=dl.persistent_workers, prefetch_factor=dl.prefetch_factor)
+    if not {'dataset', 'sampler', 'shuffle'} & set(kwargs) and not isinstance(dl.sampler, (RandomSampler, SequentialSampler)):
+        params['sampler'] = dl.sampler  # custom samplers (DistributedSampler, BlockSampler,..) are kept
+    shuffle = kwargs.pop('shuffle', isinstance(dl.sampler, RandomSampler))
+    params.update(kwargs)
+    if params.get('sampler') is None:
+        params['shuffle'] = shuffle
+    if params['num_workers'] == 0:
+        params['prefetch_factor'], params['persistent_workers'] = None, False
+    return DataLoader(**params)
@@ -0,0 +1,118 @@
+from itertools import islice
+import torch
+import torch.distributed as dist
+from .callbacks import Callback
+from .prefetch import PrefetchCB
+from .utils import is_distributed, rebuild_dataloader
+from ..exceptions import CancelEpochException
+
+__all__ = ['FirstBatches', 'IntervalValidationCB']
+
+
+class FirstBatches():
+    ''' the first n batches of a dataloader '''
+
+    def __init__(self, dl, n):
+        self.dl, self.n = dl, n
+
+    def __iter__(self):
+        return islice(self.dl, self.n)
+
+    def __len__(self):
+        return min(self.n, len(self.dl))
+
+    @property
+    def dataset(self):
+        return self.dl.dataset
+
+    @property
+    def sampler(self):
+        return getattr(self.dl, 'sampler', None)
+
+
+class IntervalValidationCB(Callback):
+    """Validates every `every_batches` training batches and/or every `every_epochs` epochs,
+    instead of after every training epoch. The validation of the last epoch always runs.
+
+    The validations can run on a part of the validation set, the first `n_batches` batches
+    or a fixed random `subset` of samples (the same samples every time), while the last one
+    runs on the whole validation set unless full_final is False.
+
+    MetricsCB keeps separate training and validation metrics, so a validation in the middle of an epoch
+    doesn't reset the training ones, and ProgressCB draws the validation losses at the training batch they were computed.
+    Epoch schedulers (EpochSchedCB) still step once per training epoch.
+
+    example usage:
+    learn.fit(10, callbacks=[IntervalValidationCB(every_batches=500, every_epochs=None, subset=0.1)])
+    """
+    order = PrefetchCB.order-1  # it chooses the validation dataloader before it's wrapped
+
+    def __init__(self, every_batches=None, every_epochs=1, n_batches=None, subset=None, full_final=True, seed=42):
+        """
+        Args:
+            every_batches (int, optional): validate every `every_batches` optimizer steps. Defaults to None.
+            every_epochs (int, optional): validate at the end of every `every_epochs` epochs,
+                None validates at the end of the last epoch only. Defaults to 1.
+            n_batches (int, optional): validate on the first n_batches batches. Defaults to None.
+            subset (int or float, optional): validate on a random subset of samples, a number or a fraction
+                of the validation set. It needs a torch DataLoader (or a dataloader with a rebuild method). Defaults to None.
+            full_final (bool, optional): validate the last epoch on the whole validation set. Defaults to True.
+            seed (int, optional): seed of the subset samples. Defaults to 42.
+        """
+        assert n_batches is None or subset is None, 'use n_batches or subset'
+        self.every_batches, self.every_epochs, self.n_batches, self.subset = every_batches, every_epochs, n_batches, subset
+        self.full_final, self.seed = full_final, seed
+
+    def before_fit(self, learn):
+        self.partial_dl = None
+        self.steps = 0
+        self.mid_epoch = False
+
+    def _final(self, learn, epoch):
+        return epoch == learn.n_epochs - 1
+
+    def _validates_epoch(self, learn, epoch):
+        return self._final(learn, epoch) or bool(self.every_epochs) and (epoch + 1) % self.every_epochs == 0
+
+    def _subset_dl(self, dl):
+        n = len(dl.dataset)
+        k = self.subset if isinstance(self.subset, int) else int(n * self.subset)
+        idx = torch.randperm(n, generator=torch.Generator().manual_seed(self.seed))[:k].sort().values
+        if is_distributed():  # every process validates its share of the subset
+            idx = idx[dist.get_rank()::dist.get_world_size()]
+        return rebuild_dataloader(dl, sampler=idx.tolist(), shuffle=None)
+
+    def _partial(self, learn):
+        if self.partial_dl is None:
+            # built on first use, from the validation dataloader already sharded by DistributedCB
+            dl = learn.dataloaders.valid
+            if self.n_batches is not None:
+                self.partial_dl = FirstBatches(dl, self.n_batches)
+            elif self.subset is not None:
+                self.partial_dl = self._subset_dl(dl)
+            else:
+                self.partial_dl = dl
+        return self.partial_dl
+
+    def before_epoch(self, learn):
+        if learn.training:
+            return
+        final = not self.mid_epoch and self._final(learn, learn.epoch)
+        if not self.mid_epoch and not self._validates_epoch(learn, learn.epoch):
+            raise CancelEpochException()
+        if not (final and self.full_final):
+            learn.dl = self._partial(learn)
+
+    def after_batch(self, learn):
+        if not self.every_batches or not learn.training or not learn.stepped:
+            return
+        self.steps += 1
+        if self.steps % self.every_batches:
+            return
+        if learn.iter + 1 == learn.n_iter and self._validates_epoch(learn, learn.epoch):
+            return  # the epoch validation comes next
+        self.mid_epoch = True
+        try:
+            learn.validate()
+        finally:
+            self.mid_epoch = False
@@ -0,0 +1,371 @@
+'''
+Dataloaders for the Learner, with a fast path for datasets held in memory as tensors
+and a memory mapped on-disk format for the datasets larger than RAM.
+
+example usage:
+dls = DataLoaders.from_tensors((x_train, y_train), (x_valid, y_valid), batch_size=256, device='cuda')
+learn = Learner(model, dls, callbacks=[DeviceCB('cuda'), TrainCB(), MetricsCB(), ProgressCB()])
+
+convert_dataset(train_ds, 'data/train', shuffle=True, num_workers=8)
+convert_dataset(valid_ds, 'data/valid', num_workers=8)
+dls = DataLoaders.from_memmap('data/train', 'data/valid', batch_size=256, num_workers=4)
+'''
+import os
+import json
+import math
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler, TensorDataset, RandomSampler, SequentialSampler
+from .callbacks.utils import is_shuffled
+
+__all__ = ['TensorDataLoader', 'convert_dataset', 'MemmapDataset', 'memmap_collate', 'BlockSampler',
+           'memmap_dataloader', 'DataLoaders']
+
+
+class TensorDataLoader():
+    """Batches of tensors held in memory (optionally on the device), without per sample work:
+    every epoch is shuffled with a single randperm and the batches are slices of the tensors
+    (views, no copies) or index_select of the shuffled indices.
+
+    It has the DataLoader attributes used by the callbacks (dataset, sampler, batch_size) and a rebuild method
+    for rebuild_dataloader, so it works with DistributedCB, IntervalValidationCB, autotune and Learner.get_preds.
+    Any other sampler (like DistributedSampler) is iterated once per epoch to get the indices.
+    """
+
+    def __init__(self, *tensors, batch_size=64, shuffle=False, drop_last=False, device=None, sampler=None):
+        """
+        Args:
+            tensors (Tensor): the dataset, tensors with the same first dimension (like x and y)
+            batch_size (int, optional): batch size. Defaults to 64.
+            shuffle (bool, optional): shuffle every epoch. Defaults to False.
+            drop_last (bool, optional): drop the last incomplete batch. Defaults to False.
+            device (str, optional): move the tensors to device once. Defaults to None.
+            sampler (Sampler, optional): sampler of the indices, it replaces shuffle. Defaults to None.
+        """
+        assert all(len(t) == len(tensors[0]) for t in tensors), 'the tensors must have the same length'
+        self.tensors = tuple(t.to(device) for t in tensors) if device is not None else tensors
+        self.dataset = TensorDataset(*self.tensors)
+        self.batch_size, self.drop_last, self.device = batch_size, drop_last, device
+        if sampler is None:
+            sampler = RandomSampler(self.dataset) if shuffle else SequentialSampler(self.dataset)
+        self.sampler = sampler
+
+    def __len__(self):
+        n = len(self.sampler)
+        return n // self.batch_size if self.drop_last else math.ceil(n / self.batch_size)
+
+    def _indices(self):
+        ''' indices of the epoch, None when the batches are plain slices '''
+        if type(self.sampler) is SequentialSampler:
+            return None
+        if type(self.sampler) is RandomSampler and not self.sampler.replacement \
+                and self.sampler.num_samples == len(self.dataset):
+            idx = torch.randperm(len(self.dataset), generator=self.sampler.generator)
+        else:
+            idx = torch.as_tensor(list(self.sampler), dtype=torch.long)
+        return idx.to(self.tensors[0].device)
+
+    def __iter__(self):
+        idx, bs = self._indices(), self.batch_size
+        for i in range(len(self)):
+            if idx is None:
+                yield tuple(t[i*bs:(i+1)*bs] for t in self.tensors)
+            else:
+                batch = idx[i*bs:(i+1)*bs]
+                yield tuple(t.index_select(0, batch) for t in self.tensors)
+
+    def rebuild(self, **kwargs):
+        """new TensorDataLoader with the same tensors, used by rebuild_dataloader.
+        It accepts the DataLoader arguments dataset (a TensorDataset), batch_size, shuffle, sampler and drop_last,
+        the others (num_workers, pin_memory,..) have no meaning here and are ignored.
+        """
+        tensors = kwargs['dataset'].tensors if kwargs.get('dataset') is not None else self.tensors
+        sampler, shuffle = kwargs.get('sampler'), kwargs.get('shuffle')
+        if sampler is None and shuffle is None:
+            # same sampling, a plain sampler of the new dataset
+            shuffle = is_shuffled(self.sampler)
+        return TensorDataLoader(*tensors, batch_size=kwargs.get('batch_size', self.batch_size), shuffle=bool(shuffle),
+                                drop_last=kwargs.get('drop_last', self.drop_last), device=self.device, sampler=sampler)
+
+
+def _fields(batch):
+    return tuple(batch) if isinstance(batch, (tuple, list)) else (batch,)
+
+
+def convert_dataset(ds, path, shard_size=65536, batch_size=256, num_workers=0, shuffle=False, seed=42):
+    """writes a dataset in the memory mapped format of MemmapDataset: every field of the samples (like x and y)
+    is stored in .npy shards of shard_size samples with a fixed dtype and shape, plus an index.json
+    with the length, the shard size and the dtype and shape of every field.
+    The samples are read with a DataLoader, so num_workers speeds up the datasets that decode files.
+
+    Args:
+        ds (Dataset): any map-style dataset, its samples are tensors, arrays or numbers (or tuples of them) of fixed shape
+        path (str): output directory
+        shard_size (int, optional): samples of every shard. Defaults to 65536.
+        batch_size (int, optional): samples read at a time. Defaults to 256.
+        num_workers (int, optional): DataLoader workers reading the dataset. Defaults to 0.
+        shuffle (bool, optional): store the samples in a random order, so that the contiguous blocks of BlockSampler
+            mix the samples of the original order (like classes stored one after the other). Defaults to False.
+        seed (int, optional): seed of the shuffling. Defaults to 42.
+
+    Returns:
+        MemmapDataset: the converted dataset
+    """
+    os.makedirs(path, exist_ok=True)
+    n = len(ds)
+    sampler = torch.randperm(n, generator=torch.Generator().manual_seed(seed)).tolist() if shuffle else None
+    dl = DataLoader(ds, batch_size=batch_size, sampler=sampler, num_workers=num_workers)
+    fields, shard, pos = None, None, 0
+    for batch in dl:
+        arrays = [np.asarray(f) for f in _fields(batch)]
+        if fields is None:
+            fields = [{'dtype': a.dtype.str, 'shape': list(a.shape[1:])} for a in arrays]
+        start = 0
+        while start < len(arrays[0]):
+            s, offset = divmod(pos, shard_size)
+            if offset == 0:
+                rows = min(shard_size, n - pos)
+                shard = [np.lib.format.open_memmap(os.path.join(path, f'{j}.{s:05d}.npy'), mode='w+', dtype=a.dtype,
+                                                   shape=(rows, *a.shape[1:])) for j, a in enumerate(arrays)]
+            k = min(len(arrays[0]) - start, len(shard[0]) - offset)
+            for out, a in zip(shard, arrays):
+                out[offset:offset + k] = a[start:start + k]
+            start, pos = start + k, pos + k
+            if offset + k == len(shard[0]):
+                [out.flush() for out in shard]
+    with open(os.path.join(path, 'index.json'), 'w') as f:
+        json.dump({'length': n, 'shard_size': shard_size, 'n_shards': math.ceil(n / shard_size), 'fields': fields}, f)
+    return MemmapDataset(path)
+
+
+class MemmapDataset(Dataset):
+    """Dataset of the shards written by convert_dataset, memory mapped: a sample or a batch of contiguous
+    samples is a zero-copy view of the files (torch.from_numpy), the pages are loaded by the OS when read
+    and shared through the page cache by all the processes, so the DataLoader workers don't duplicate memory.
+    The shards are opened lazily in every process (they aren't pickled with the dataset).
+
+    __getitems__ reads a whole batch: the runs of consecutive indices are read as ranges, so the batches
+    of a BlockSampler are a single range read. Its batch is already collated, the DataLoader needs collate_fn=memmap_collate
+    (memmap_dataloader sets it).
+    The views are copy-on-write, writing them doesn't change the files.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): directory written by convert_dataset
+        """
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        self.length, self.shard_size, self.n_shards = index['length'], index['shard_size'], index['n_shards']
+        self.fields = index['fields']
+        self._shards = None
+
+    def __getstate__(self):
+        return {**self.__dict__, '_shards': None}  # every process maps the files itself
+
+    @property
+    def shards(self):
+        if self._shards is None:
+            self._shards = [[np.load(os.path.join(self.path, f'{j}.{s:05d}.npy'), mmap_mode='c')
+                             for j in range(len(self.fields))] for s in range(self.n_shards)]
+        return self._shards
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        s, offset = divmod(i, self.shard_size)
+        return tuple(torch.as_tensor(a[offset]) for a in self.shards[s])
+
+    def _range(self, start, stop):
+        # contiguous samples, a view when they are in the same shard
+        first, last = start // self.shard_size, (stop - 1) // self.shard_size
+        parts = [[a[max(start - s * self.shard_size, 0):stop - s * self.shard_size] for a in self.shards[s]]
+                 for s in range(first, last + 1)]
+        return parts[0] if len(parts) == 1 else [np.concatenate(p) for p in zip(*parts)]
+
+    def _gather(self, idx):
+        # scattered samples, a copy
+        shard, offset = np.divmod(idx, self.shard_size)
+        out = [np.empty((len(idx), *f['shape']), dtype=f['dtype']) for f in self.fields]
+        for s in np.unique(shard):
+            mask = shard == s
+            for o, a in zip(out, self.shards[s]):
+                o[mask] = a[offset[mask]]
+        return out
+
+    def get_range(self, start, stop):
+        """samples from start to stop, zero-copy views when they are in the same shard
+
+        Returns:
+            tuple: a batch tensor for every field
+        """
+        return tuple(torch.from_numpy(a) for a in self._range(start, stop))
+
+    def __getitems__(self, indices):
+        idx = np.asarray(indices, dtype=np.int64)
+        breaks = np.flatnonzero(np.diff(idx) != 1) + 1
+        if len(breaks) == 0:
+            return self.get_range(int(idx[0]), int(idx[-1]) + 1)
+        if len(breaks) > len(idx) // 8:  # mostly scattered indices
+            return tuple(torch.from_numpy(a) for a in self._gather(idx))
+        runs = [self._range(int(r[0]), int(r[-1]) + 1) for r in np.split(idx, breaks)]
+        return tuple(torch.from_numpy(np.concatenate(p)) for p in zip(*runs))
+
+
+def memmap_collate(batch):
+    ''' collate_fn of the DataLoaders of a MemmapDataset, its batches are already collated by __getitems__ '''
+    return batch
+
+
+class BlockSampler(Sampler):
+    """Shuffles blocks of block_size contiguous samples instead of single samples, the samples in a block
+    stay in order. With a block_size multiple of the batch size every batch is a single range read of a MemmapDataset.
+    Store the dataset in random order (convert_dataset with shuffle) to mix the samples of a block.
+
+    With DistributedCB every process gets its share of the blocks (shard), padded with the first blocks
+    so all the processes have the same number of samples, like DistributedSampler.
+    """
+
+    def __init__(self, n, block_size=1024, shuffle=True, seed=None, rank=0, world_size=1):
+        """
+        Args:
+            n (int): samples of the dataset
+            block_size (int, optional): samples of a block. Defaults to 1024.
+            shuffle (bool, optional): shuffle the blocks every epoch. Defaults to True.
+            seed (int, optional): seed of the shuffling, combined with the epoch setted by set_epoch.
+                Defaults to None (the global torch rng).
+            rank (int, optional): process of this sampler. Defaults to 0.
+            world_size (int, optional): number of processes. Defaults to 1.
+        """
+        self.n, self.block_size, self.shuffle, self.seed = n, block_size, shuffle, seed
+        self.rank, self.world_size, self.epoch = rank, world_size, 0
+        self.n_blocks = math.ceil(n / block_size)
+        self.rank_blocks = math.ceil(self.n_blocks / world_size)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def shard(self, rank, world_size):
+        ''' the sampler of a process, the processes shuffle with the same seed '''
+        return BlockSampler(self.n, self.block_size, self.shuffle, self.seed or 0, rank, world_size)
+
+    def _order(self):
+        if not self.shuffle:
+            return torch.arange(self.n_blocks)
+        generator = None if self.seed is None else torch.Generator().manual_seed(self.seed + self.epoch)
+        return torch.randperm(self.n_blocks, generator=generator)
+
+    def __iter__(self):
+        blocks = self._order().tolist()
+        if self.world_size == 1:
+            for b in blocks:
+                yield from range(b * self.block_size, min((b + 1) * self.block_size, self.n))
+            return
+        blocks = (blocks * math.ceil(self.rank_blocks * self.world_size / len(blocks)))[:self.rank_blocks * self.world_size]
+        for b in blocks[self.rank::self.world_size]:
+            # full blocks, the last one wraps to the first samples
+            yield from (i % self.n for i in range(b * self.block_size, (b + 1) * self.block_size))
+
+    def __len__(self):
+        return self.n if self.world_size == 1 else self.rank_blocks * self.block_size
+
+
+def memmap_dataloader(ds, batch_size=64, shuffle=False, block_size=None, seed=None, **kwargs):
+    """DataLoader of a MemmapDataset reading every batch with range reads
+
+    Args:
+        ds (MemmapDataset or str): the dataset or its directory
+        batch_size (int, optional): batch size. Defaults to 64.
+        shuffle (bool, optional): shuffle the blocks every epoch (BlockSampler). Defaults to False.
+        block_size (int, optional): samples of a shuffled block. Defaults to None (the batch size).
+        seed (int, optional): seed of the BlockSampler. Defaults to None.
+        kwargs: other DataLoader arguments (num_workers, pin_memory,..)
+
+    Returns:
+        DataLoader: the dataloader
+    """
+    ds = ds if isinstance(ds, MemmapDataset) else MemmapDataset(ds)
+    sampler = BlockSampler(len(ds), block_size or batch_size, shuffle, seed)
+    return DataLoader(ds, batch_size=batch_size, sampler=sampler, collate_fn=memmap_collate, **kwargs)
+
+
+class DataLoaders():
+    """train and valid dataloaders of the Learner
+
+    example usage:
+    dls = DataLoaders.from_datasets(train_ds, valid_ds, batch_size=128, num_workers=4)
+    """
+
+    def __init__(self, train, valid):
+        self.train, self.valid = train, valid
+
+    @classmethod
+    def from_tensors(cls, train, valid, batch_size=64, valid_batch_size=None, shuffle=True, drop_last=False, device=None):
+        """in memory dataloaders (TensorDataLoader)
+
+        Args:
+            train (tuple): training tensors, like (x, y)
+            valid (tuple): validation tensors
+            batch_size (int, optional): training batch size. Defaults to 64.
+            valid_batch_size (int, optional): validation batch size. Defaults to None (2x batch_size).
+            shuffle (bool, optional): shuffle the training set every epoch. Defaults to True.
+            drop_last (bool, optional): drop the last incomplete training batch. Defaults to False.
+            device (str, optional): keep the tensors on device. Defaults to None.
+
+        Returns:
+            DataLoaders: the dataloaders
+        """
+        valid_batch_size = valid_batch_size or batch_size * 2
+        return cls(TensorDataLoader(*train, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last, device=device),
+                   TensorDataLoader(*valid, batch_size=valid_batch_size, device=device))
+
+    @classmethod
+    def from_datasets(cls, train_ds, valid_ds, batch_size=64, valid_batch_size=None, shuffle=True, device=None, **kwargs):
+        """dataloaders of two datasets, TensorDatasets take the in memory fast path (TensorDataLoader),
+        the others get torch DataLoaders
+
+        Args:
+            train_ds (Dataset): training dataset
+            valid_ds (Dataset): validation dataset
+            batch_size (int, optional): training batch size. Defaults to 64.
+            valid_batch_size (int, optional): validation batch size. Defaults to None (2x batch_size).
+            shuffle (bool, optional): shuffle the training set every epoch. Defaults to True.
+            device (str, optional): keep the TensorDatasets on device. Defaults to None.
+            kwargs: other DataLoader arguments (num_workers, collate_fn,..)
+
+        Returns:
+            DataLoaders: the dataloaders
+        """
+        valid_batch_size = valid_batch_size or batch_size * 2
+
+        def dl(ds, bs, shuffle):
+            if isinstance(ds, TensorDataset):
+                return TensorDataLoader(*ds.tensors, batch_size=bs, shuffle=shuffle,
+                                        drop_last=kwargs.get('drop_last', False), device=device)
+            return DataLoader(ds, batch_size=bs, shuffle=shuffle, **kwargs)
+        return cls(dl(train_ds, batch_size, shuffle), dl(valid_ds, valid_batch_size, False))
+
+    @classmethod
+    def from_memmap(cls, train, valid, batch_size=64, valid_batch_size=None, shuffle=True, block_size=None, **kwargs):
+        """dataloaders of two MemmapDatasets (written by convert_dataset), see memmap_dataloader
+
+        Args:
+            train (MemmapDataset or str): training dataset or its directory
+            valid (MemmapDataset or str): validation dataset or its directory
+            batch_size (int, optional): training batch size. Defaults to 64.
+            valid_batch_size (int, optional): validation batch size. Defaults to None (2x batch_size).
+            shuffle (bool, optional): shuffle the blocks of the training set every epoch. Defaults to True.
+            block_size (int, optional): samples of a shuffled block. Defaults to None (the batch size).
+            kwargs: other DataLoader arguments (num_workers, pin_memory,..)
+
+        Returns:
+            DataLoaders: the dataloaders
+        """
+        valid_batch_size = valid_batch_size or batch_size * 2
+        return cls(memmap_dataloader(train, batch_size, shuffle, block_size, **kwargs),
+                   memmap_dataloader(valid, valid_batch_size, **kwargs))
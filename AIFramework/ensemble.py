@@ -0,0 +1,180 @@
+'''
+Ensembles of N copies of the same architecture, trained together in a single pass with torch.func.
+
+example usage:
+learn = EnsembleLearner.from_seeds(lambda: get_model(), seeds=range(8), dataloaders=dls, lr=0.01,
+                                   callbacks=[EnsembleTrainCB(), EnsembleMetricsCB(8, accuracy=MulticlassAccuracy())])
+learn.fit(5)
+models = learn.export_members()
+'''
+from copy import deepcopy
+import torch
+import torch.nn.functional as F
+from torch import nn, optim
+from torch.func import functional_call, stack_module_state, vmap
+
+from .Learner import Learner
+from .callbacks.callbacks import TrainCB
+from .callbacks.metrics import MetricsCB, DeviceMean
+from .callbacks.checkpoint import unwrap_model
+from .callbacks.utils import to_cpu
+
+__all__ = ['EnsembleModule', 'EnsembleTrainCB', 'EnsembleMetricsCB', 'EnsembleLearner']
+
+
+def _key(name):
+    return name.replace('.', '-')  # parameter names can't contain dots
+
+
+class EnsembleModule(nn.Module):
+    """N models of the same architecture, with their parameters and buffers stacked along a first dimension
+    of size N. The forward runs all the members on the same input with vmap, the output has shape (N, *member output).
+
+    BatchNorm layers that track running stats can't update them under vmap in training,
+    use torch.func.replace_all_batch_norm_modules_ on the models, or track_running_stats=False.
+    """
+
+    def __init__(self, models):
+        """
+        Args:
+            models (list): the members, nn.Modules with the same architecture
+        """
+        super().__init__()
+        params, buffers = stack_module_state(list(models))
+        self.n_members = len(models)
+        self.names, self.buffer_names = list(params), list(buffers)
+        self.params = nn.ParameterDict({_key(k): nn.Parameter(v) for k, v in params.items()})
+        for k, v in buffers.items():
+            self.register_buffer(_key(k), v)
+        # stateless copy of the architecture, not registered as submodule so its parameters aren't trained
+        object.__setattr__(self, 'base', deepcopy(models[0]).to('meta'))
+
+    def train(self, mode=True):
+        self.base.train(mode)
+        return super().train(mode)
+
+    def _state(self):
+        params = {k: self.params[_key(k)] for k in self.names}
+        buffers = {k: getattr(self, _key(k)) for k in self.buffer_names}
+        return params, buffers
+
+    def forward(self, *xs):
+        def member(params, buffers, *xs):
+            return functional_call(self.base, (params, buffers), xs)
+        params, buffers = self._state()
+        # every member gets its own dropout masks
+        return vmap(member, in_dims=(0, 0, *[None] * len(xs)), randomness='different')(params, buffers, *xs)
+
+    def export_members(self):
+        """the members as separate modules, with copies of their trained parameters and buffers
+
+        Returns:
+            list: N nn.Modules
+        """
+        params, buffers = self._state()
+        members = []
+        for i in range(self.n_members):
+            device = next(iter(params.values())).device
+            m = deepcopy(self.base).to_empty(device=device)
+            m.load_state_dict({k: v[i].detach().clone() for k, v in {**params, **buffers}.items()})
+            m.train(self.training)
+            members.append(m)
+        return members
+
+
+class EnsembleTrainCB(TrainCB):
+    """TrainCB for EnsembleLearner: the loss of every member is computed with vmap
+    and stored in learn.member_losses, learn.loss is their sum, so every member gets the gradients
+    it would get if trained alone.
+    """
+
+    def get_loss(self, learn):
+        targets = learn.batch[self.n_inp:]
+        losses = vmap(learn.loss_func, in_dims=(0, *[None] * len(targets)))(learn.preds, *targets)
+        learn.member_losses = losses
+        learn.loss = losses.sum()
+
+
+class EnsembleMetricsCB(MetricsCB):
+    """MetricsCB for EnsembleLearner. Every metric is computed for each member (named 'accuracy_0', 'accuracy_1',..)
+    and for the ensemble, on the mean of the members predictions (named 'accuracy').
+    The loss of every member is 'loss_0', 'loss_1',.. and 'loss' is their mean.
+    """
+
+    def __init__(self, n_members, *ms, on_device=False, sync_every=None, sink=None, **metrics):
+        """
+        Args:
+            n_members (int): number of members of the ensemble
+            on_device, sync_every, sink: see MetricsCB
+        """
+        for o in ms:
+            metrics[type(o).__name__] = o
+        self.kinds = {k: (None, False) for k in metrics}  # name -> (member index, is a loss)
+        members = {}
+        for i in range(n_members):
+            for k, m in metrics.items():
+                members[f'{k}_{i}'] = deepcopy(m)
+                self.kinds[f'{k}_{i}'] = i, False
+            if on_device:
+                members[f'loss_{i}'] = DeviceMean()
+            else:
+                from torcheval.metrics import Mean
+                members[f'loss_{i}'] = Mean()
+            self.kinds[f'loss_{i}'] = i, True
+        super().__init__(on_device=on_device, sync_every=sync_every, sink=sink, **metrics, **members)
+
+    def after_batch(self, learn):
+        self._phase(learn)
+        x, y, *_ = learn.batch
+        preds, losses = learn.preds.detach(), learn.member_losses.detach()
+        if not self.on_device:
+            preds, losses, y = to_cpu(preds), to_cpu(losses), to_cpu(y)
+        elif self.device is None:
+            self.device = preds.device
+            [o.to(self.device) for o in self.all_metrics.values()]
+        mean_preds = preds.mean(0)
+        for k, m in self.metrics.items():
+            i, is_loss = self.kinds[k]
+            if is_loss:
+                m.update(losses[i], weight=len(x))
+            else:
+                m.update(mean_preds if i is None else preds[i], y)
+        self.loss.update(losses.mean(), weight=len(x))
+        if self.on_device and self.sync_every and (learn.iter + 1) % self.sync_every == 0:
+            self.values = {k: v.compute().tolist() for k, v in self.all_metrics.items()}
+
+
+class EnsembleLearner(Learner):
+    '''
+    Learner training N models of the same architecture together, as one EnsembleModule.
+    Use it with EnsembleTrainCB (and EnsembleMetricsCB), learn.model(x) returns the predictions of all the members.
+    '''
+
+    def __init__(self, models, dataloaders=(0,), loss_func=F.cross_entropy, lr=0.1, callbacks=None, opt_func=optim.SGD,
+                 **kwargs):
+        '''
+        models: the members, nn.Modules with the same architecture and different initializations
+        other arguments: see Learner
+        '''
+        super().__init__(EnsembleModule(models), dataloaders, loss_func, lr, callbacks, opt_func, **kwargs)
+
+    @classmethod
+    def from_seeds(cls, model_fn, seeds, **kwargs):
+        '''
+        builds the members calling model_fn() after seeding torch with every seed
+        '''
+        models = []
+        for seed in seeds:
+            torch.manual_seed(seed)
+            models.append(model_fn())
+        return cls(models, **kwargs)
+
+    @property
+    def n_members(self):
+        return unwrap_model(self.model).n_members
+
+    def export_members(self):
+        '''
+        the trained members as separate nn.Modules
+        '''
+        return unwrap_model(self.model).export_members()
@@ -0,0 +1,171 @@
+'''
+Int8 quantization of a trained model for cpu inference: dynamic quantization of Linear/LSTM layers
+or static quantization (FX graph mode) calibrated on batches of dataloaders.valid,
+with the validation metrics and the speed of the fp32 and int8 models.
+
+example usage:
+learn.fit(5)
+res = learn.quantize(mode='static', n_batches=20, batch_sizes=[1, 32, 256])
+res['delta']  # {'accuracy': -0.002, 'loss': 0.004}
+torch.save(res['model'].state_dict(), 'model_int8.pth')
+'''
+from copy import copy, deepcopy
+from itertools import islice
+from operator import attrgetter
+import fastcore.all as fc
+import torch
+from torch import nn
+
+from .autotune import bare_callbacks, isolated_fit
+from .callbacks.checkpoint import unwrap_model
+from .callbacks.device import DeviceCB
+from .callbacks.metrics import MetricsCB
+
+__all__ = ['quantize_dynamic', 'quantize_static', 'cpu_batches', 'validate_on_cpu', 'quantize']
+
+
+def _engine(backend):
+    engines = torch.backends.quantized.supported_engines
+    backend = backend or ('x86' if 'x86' in engines else 'qnnpack')
+    torch.backends.quantized.engine = backend  # the quantized kernels used to run the model
+    return backend
+
+
+def _cpu_copy(model):
+    return deepcopy(unwrap_model(model)).cpu().eval()
+
+
+def quantize_dynamic(model, layers=(nn.Linear, nn.LSTM), dtype=torch.qint8, backend=None):
+    """int8 dynamic quantization: the weights of the layers are stored in int8,
+    the activations are quantized on the fly, no calibration needed. Best for Linear and LSTM heavy models.
+
+    Args:
+        model (nn.Module): the trained model, it isn't modified
+        layers (tuple, optional): layer types to quantize. Defaults to (nn.Linear, nn.LSTM).
+        dtype (torch.dtype, optional): torch.qint8 or torch.float16. Defaults to torch.qint8.
+        backend (str, optional): quantized engine, 'x86', 'fbgemm', 'qnnpack',.. Defaults to None (x86 if supported).
+
+    Returns:
+        nn.Module: the quantized copy of the model, on cpu
+    """
+    from torch.ao.quantization import quantize_dynamic as quantize
+    _engine(backend)
+    return quantize(_cpu_copy(model), set(layers), dtype=dtype)
+
+
+def quantize_static(model, batches, backend=None):
+    """int8 static quantization with FX graph mode: weights and activations are int8, with activation ranges
+    observed on calibration batches. The model must be symbolically traceable (torch.fx).
+
+    Args:
+        model (nn.Module): the trained model, it isn't modified
+        batches (iterable): calibration inputs, a tuple of cpu model inputs for every batch
+        backend (str, optional): quantized engine, 'x86', 'fbgemm', 'qnnpack',.. Defaults to None (x86 if supported).
+
+    Returns:
+        nn.Module: the quantized copy of the model, on cpu
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    backend = _engine(backend)
+    batches = iter(batches)
+    first = next(batches)
+    prepared = prepare_fx(_cpu_copy(model), get_default_qconfig_mapping(backend), first)
+    with torch.inference_mode():
+        for xs in (first, *batches):
+            prepared(*xs)
+    return convert_fx(prepared)
+
+
+def cpu_batches(learn, dl=None, n_batches=None, n_inp=1):
+    """model inputs of the first n_batches of a dataloader, on cpu, after the transforms of the callbacks
+    exposing transform_batch (BatchTransformCB,..), the ones the model gets during validation
+
+    Args:
+        learn (Learner): the learner
+        dl (DataLoader, optional): the dataloader. Defaults to None (dataloaders.valid).
+        n_batches (int, optional): number of batches. Defaults to None (all).
+        n_inp (int, optional): number of model inputs in the batch. Defaults to 1.
+
+    Yields:
+        tuple: the inputs of a batch
+    """
+    dl = learn.dataloaders.valid if dl is None else dl
+    cbs = [cb for cb in sorted(learn.callbacks, key=attrgetter('order'))
+           if hasattr(cb, 'transform_batch') and not isinstance(cb, DeviceCB)]
+    for batch in islice(dl, n_batches):
+        batch = tuple(o.cpu() if isinstance(o, torch.Tensor) else o for o in batch)
+        for cb in cbs:
+            batch = cb.transform_batch(batch, False)
+        yield tuple(batch[:n_inp])
+
+
+def _fresh_metrics(cb):
+    # copy of a MetricsCB with its own metrics and values, that doesn't log
+    cb = copy(cb)
+    cb.phases, cb.values, cb.sink, cb._log = deepcopy(cb.phases), {}, None, fc.noop
+    return cb
+
+
+def validate_on_cpu(learn, model):
+    """runs a validation epoch of model on cpu, with the batch transforms and the train callback
+    of the learner (bare_callbacks, on cpu and without autocast) and a copy of its MetricsCB.
+    The other callbacks aren't run and the attributes of the learner are restored (see isolated_fit),
+    so the recorder, the activation stats, the schedulers and learn.metrics are left unchanged.
+
+    Args:
+        learn (Learner): the learner, it needs a MetricsCB
+        model (nn.Module): model validated in place of learn.model
+
+    Returns:
+        dict: the values of MetricsCB
+    """
+    ms = [cb for cb in learn.callbacks if isinstance(cb, MetricsCB)]
+    assert ms, 'validate_on_cpu needs a MetricsCB'
+    metrics = _fresh_metrics(ms[-1])
+    with isolated_fit(learn, bare_callbacks(learn, device='cpu', amp=False, prefetch=False) + [metrics]):
+        learn.model, learn.opt_func = model, None  # no optimizer, the quantized models have no parameters
+        learn.fit(1, train=False)
+    return dict(metrics.values)
+
+
+def quantize(learn, mode='dynamic', n_batches=10, n_inp=1, backend=None, layers=(nn.Linear, nn.LSTM),
+             validate=True, batch_sizes=(1, 32, 256), verbose=True):
+    """quantizes the trained model of the learner to int8 and compares it with the fp32 one on cpu:
+    validation metrics (MetricsCB on dataloaders.valid) and latency and throughput at several batch sizes.
+    learn.model isn't changed.
+
+    Args:
+        learn (Learner): the learner
+        mode (str, optional): 'dynamic' (quantize_dynamic) or 'static' (quantize_static). Defaults to 'dynamic'.
+        n_batches (int, optional): calibration batches of dataloaders.valid, for static. Defaults to 10.
+        n_inp (int, optional): number of model inputs in the batch. Defaults to 1.
+        backend (str, optional): quantized engine. Defaults to None (x86 if supported).
+        layers (tuple, optional): layer types quantized by dynamic. Defaults to (nn.Linear, nn.LSTM).
+        validate (bool, optional): compare the validation metrics, it needs a MetricsCB. Defaults to True.
+        batch_sizes (list, optional): batch sizes of the speed comparison, None skips it. Defaults to (1, 32, 256).
+        verbose (bool, optional): print the comparison. Defaults to True.
+
+    Returns:
+        dict: 'model' the quantized model, 'fp32' and 'int8' the validation metrics, 'delta' int8 - fp32 for the
+            numeric metrics, 'bench' the latency and throughput for every batch size (see bench_quantization)
+    """
+    assert mode in ('dynamic', 'static'), "mode is 'dynamic' or 'static'"
+    fp32 = _cpu_copy(learn.model)
+    if mode == 'dynamic':
+        int8 = quantize_dynamic(fp32, layers, backend=backend)
+    else:
+        int8 = quantize_static(fp32, cpu_batches(learn, n_batches=n_batches, n_inp=n_inp), backend)
+    res = {'model': int8}
+    if validate:
+        res['fp32'], res['int8'] = validate_on_cpu(learn, fp32), validate_on_cpu(learn, int8)
+        res['delta'] = {k: v - res['fp32'][k] for k, v in res['int8'].items()
+                        if isinstance(v, (int, float)) and isinstance(res['fp32'].get(k), (int, float))}
+        if verbose:
+            print(' '.join(f'{k}: {res["fp32"][k]:.4f} -> {v:.4f} ({res["delta"][k]:+.4f})'
+                           for k, v in res['int8'].items() if k in res['delta']))
+    if batch_sizes:
+        from .benchmarks import bench_quantization
+        xs = next(cpu_batches(learn, n_batches=1, n_inp=n_inp))
+        res['bench'] = bench_quantization(fp32, int8, xs, batch_sizes, verbose=verbose)
+    return res
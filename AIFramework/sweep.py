@@ -0,0 +1,185 @@
+'''
+Hyperparameter sweeps running the trials concurrently in a pool of processes.
+
+model_fn and dls_fn must be picklable (defined at module level), they are called in every trial process.
+
+example usage:
+def get_model(): return nn.Sequential(...)
+def get_dls(): return SimpleNamespace(train=DataLoader(...), valid=DataLoader(...))
+
+space = {'lr': [1e-3, 3e-3, 1e-2], 'opt_func': [optim.SGD, optim.AdamW],
+         'sched': [None, partial(lr_scheduler.OneCycleLR, max_lr=1e-2, total_steps=500)]}
+table = sweep(get_model, get_dls, space, n_epochs=5, n_workers=4, metrics={'accuracy': MulticlassAccuracy()})
+'''
+import os
+import time
+import itertools
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+import fastcore.all as fc
+import torch
+from torch import optim
+
+from .Learner import Learner
+from .callbacks.callbacks import Callback, TrainCB
+from .callbacks.metrics import MetricsCB
+from .callbacks.scheduler import BatchSchedCB
+from .exceptions import CancelFitException
+
+# sweep() isn't exported, so `from AIFramework import *` doesn't shadow this module: use `from AIFramework.sweep import sweep`
+__all__ = ['grid', 'MedianPruneCB']
+
+
+def grid(space):
+    """all the combinations of a search space
+
+    Args:
+        space (dict): values to try for every parameter, like {'lr': [1e-3, 1e-2], 'opt_func': [optim.SGD]}
+
+    Returns:
+        list: a config dict for every combination
+    """
+    return [dict(zip(space, values)) for values in itertools.product(*space.values())]
+
+
+class MedianPruneCB(Callback):
+    """Stops a trial at the end of a validation epoch if its metric is worse than the median of the other trials
+    at the same epoch. The values of all the trials are shared through a multiprocessing Manager dict.
+    """
+    order = MetricsCB.order+1  # reads the metrics computed in after_epoch
+
+    def __init__(self, shared, trial, monitor='loss', mode='min', warmup_epochs=1, min_trials=3):
+        """
+        Args:
+            shared (dict): Manager dict shared by the trials, (trial, epoch) -> value
+            trial (int): id of this trial
+            monitor (str, optional): name of the MetricsCB metric. Defaults to 'loss'.
+            mode (str, optional): 'min' or 'max'. Defaults to 'min'.
+            warmup_epochs (int, optional): epochs never pruned. Defaults to 1.
+            min_trials (int, optional): other trials needed at the same epoch to prune. Defaults to 3.
+        """
+        fc.store_attr()
+
+    def before_fit(self, learn):
+        learn.pruned = False
+
+    def after_epoch(self, learn):
+        if learn.training:
+            return
+        value = learn.metrics.values[self.monitor]
+        self.shared[self.trial, learn.epoch] = value
+        if learn.epoch < self.warmup_epochs:
+            return
+        others = sorted(v for (t, e), v in self.shared.items() if e == learn.epoch and t != self.trial)
+        if len(others) < self.min_trials:
+            return
+        median = others[len(others) // 2]
+        if value > median if self.mode == 'min' else value < median:
+            learn.pruned = True
+            raise CancelFitException()
+
+
+class _HistoryCB(Callback):
+    order = MetricsCB.order+1
+
+    def before_fit(self, learn):
+        self.history, self.epochs = [], 0
+
+    def after_epoch(self, learn):
+        if learn.training:
+            self.epochs += 1
+        else:
+            self.history.append(dict(learn.metrics.values))
+
+
+def _name(v):
+    if isinstance(v, partial):
+        return f'{_name(v.func)}({", ".join(f"{k}={x}" for k, x in v.keywords.items())})'
+    return getattr(v, '__name__', v)
+
+
+def _init_worker(cores):
+    # every process gets its own cores, so the trials don't oversubscribe them
+    cores = cores.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    os.environ['OMP_NUM_THREADS'] = str(len(cores))
+    torch.set_num_threads(len(cores))
+
+
+def _run_trial(trial, config, model_fn, dls_fn, n_epochs, metrics, shared, prune):
+    config = dict(config)
+    lr, opt_func, sched = config.pop('lr', 0.1), config.pop('opt_func', optim.SGD), config.pop('sched', None)
+    metrics_cb = MetricsCB(**metrics)
+    metrics_cb._log = fc.noop  # the results are collected by the sweep
+    history = _HistoryCB()
+    cbs = [TrainCB(), metrics_cb, history]
+    if sched is not None:
+        cbs.append(BatchSchedCB(sched))
+    if prune is not None:
+        cbs.append(MedianPruneCB(shared, trial, **prune))
+    learn = Learner(model_fn(), dls_fn(), lr=lr, opt_func=opt_func, callbacks=cbs, **config)
+    start = time.perf_counter()
+    learn.fit(n_epochs)
+    last = history.history[-1] if history.history else {}
+    return {'trial': trial, 'epochs': history.epochs, 'pruned': getattr(learn, 'pruned', False),
+            'secs': time.perf_counter() - start, **last, 'history': history.history}
+
+
+def sweep(model_fn, dls_fn, space, n_epochs=1, n_workers=None, metrics=None, monitor='loss', mode='min',
+          prune=True, warmup_epochs=1, min_trials=3, verbose=True):
+    """runs a trial for every config of the search space, n_workers at a time in separate processes,
+    each one pinned to its share of the cpu cores.
+
+    A config sets lr, opt_func and sched (the scheduler of BatchSchedCB, a function of the optimizer),
+    the other keys are passed to the Learner (like grad_accum).
+    With prune, the trials worse than the median of the others at the end of a validation epoch
+    are stopped (CancelFitException).
+
+    Args:
+        model_fn (fn): returns a new model
+        dls_fn (fn): returns the dataloaders
+        space (dict or list): the search space, a dict of values to try for every parameter (see grid) or a list of configs
+        n_epochs (int, optional): epochs of every trial. Defaults to 1.
+        n_workers (int, optional): concurrent trials. Defaults to None (the cpu count).
+        metrics (dict, optional): MetricsCB metrics, like {'accuracy': MulticlassAccuracy()}. Defaults to None.
+        monitor (str, optional): metric used to prune and sort the trials. Defaults to 'loss'.
+        mode (str, optional): 'min' or 'max'. Defaults to 'min'.
+        prune (bool, optional): stop the losing trials early. Defaults to True.
+        warmup_epochs (int, optional): epochs never pruned. Defaults to 1.
+        min_trials (int, optional): other trials needed at the same epoch to prune. Defaults to 3.
+        verbose (bool, optional): print every finished trial and the table. Defaults to True.
+
+    Returns:
+        pandas.DataFrame: a row for every trial, with its config, epochs run, pruned flag, time
+            and the metrics of the last validation epoch, sorted from the best one
+    """
+    import pandas as pd
+    configs = grid(space) if isinstance(space, dict) else list(space)
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    n_workers = min(n_workers or len(cores), len(configs))
+    per_worker = max(1, len(cores) // n_workers)
+    ctx = mp.get_context('spawn')
+    rows = []
+    with ctx.Manager() as manager:
+        shared, queue = manager.dict(), manager.Queue()
+        for i in range(n_workers):
+            queue.put(cores[i * per_worker:(i + 1) * per_worker] or cores)
+        prune_args = dict(monitor=monitor, mode=mode, warmup_epochs=warmup_epochs, min_trials=min_trials) if prune else None
+        with ProcessPoolExecutor(n_workers, mp_context=ctx, initializer=_init_worker, initargs=(queue,)) as pool:
+            futures = {pool.submit(_run_trial, i, c, model_fn, dls_fn, n_epochs, metrics or {}, shared, prune_args): c
+                       for i, c in enumerate(configs)}
+            for future in as_completed(futures):
+                res = future.result()
+                row = {k: _name(v) for k, v in futures[future].items()}
+                row.update(res)
+                rows.append(row)
+                if verbose:
+                    status = 'pruned' if res['pruned'] else 'done'
+                    print(f'trial {res["trial"]} {status} after {res["epochs"]} epochs: '
+                          f'{monitor} {res.get(monitor, float("nan")):.4f} ({res["secs"]:.1f}s)')
+    table = pd.DataFrame(rows).sort_values(monitor, ascending=mode == 'min', ignore_index=True)
+    if verbose:
+        print(table.drop(columns='history').to_string())
+    return table
@@ -0,0 +1,53 @@
+import pytest
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, TensorDataset
+from torcheval.metrics import MulticlassAccuracy
+
+from AIFramework import DataLoaders, TrainLearner
+from AIFramework.callbacks import ActivationStats, BatchSchedCB, DeviceCB, MetricsCB, RecorderCB
+
+
+def synthetic_dls(n=96, n_in=8, n_out=3, batch_size=16, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    x = torch.randn(n, n_in, generator=g)
+    y = (x[:, :n_out].argmax(1) + (x[:, -1] > 1).long()) % n_out
+    ds = TensorDataset(x, y)
+    return DataLoaders(DataLoader(ds, batch_size=batch_size, shuffle=True), DataLoader(ds, batch_size=batch_size))
+
+
+@pytest.fixture
+def trained():
+    ''' a learner trained for an epoch, with recorder, activation stats, scheduler and metrics callbacks '''
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(8, 16), nn.ReLU(), nn.Linear(16, 3))
+    cbs = dict(rec=RecorderCB(lr=lambda cb: cb.pg['lr']),
+               stats=ActivationStats(mods=[model[0], model[2]]),
+               sched=BatchSchedCB(lambda opt: torch.optim.lr_scheduler.StepLR(opt, 2)),
+               metrics=MetricsCB(accuracy=MulticlassAccuracy()))
+    learn = TrainLearner(model, synthetic_dls(), lr=0.1, callbacks=[DeviceCB('cpu'), *cbs.values()])
+    learn.fit(1)
+    return learn, cbs
+
+
+def training_state(learn, cbs):
+    ''' what the fits of autotune and quantize must not change '''
+    return dict(callbacks=list(learn.callbacks), opt=learn.opt, scheduler=learn.scheduler,
+                metrics=learn.metrics, values=dict(cbs['metrics'].values),
+                recs={k: list(v) for k, v in cbs['rec'].recs.items()},
+                stats=[h.stats.rows.data.copy() for h in cbs['stats'].hooks],
+                sched=cbs['sched'].scheduler, last_epoch=cbs['sched'].scheduler.last_epoch,
+                params=[p.detach().clone() for p in learn.model.parameters()])
+
+
+def assert_same_state(a, b):
+    for k in ('callbacks', 'opt', 'scheduler', 'metrics', 'sched'):
+        assert a[k] is b[k] or a[k] == b[k], k
+    assert a['values'] == b['values']
+    assert a['recs'] == b['recs']
+    assert a['last_epoch'] == b['last_epoch']
+    assert len(a['stats']) == len(b['stats'])
+    for x, y in zip(a['stats'], b['stats']):
+        assert (x == y).all()
+    for x, y in zip(a['params'], b['params']):
+        assert torch.equal(x, y)
@@ -0,0 +1,10 @@
+from AIFramework.autotune import autotune
+from conftest import assert_same_state, training_state
+
+
+def test_autotune_leaves_the_training_state(trained):
+    learn, cbs = trained
+    before = training_state(learn, cbs)
+    res = autotune(learn, batch_sizes=[8, 16], num_workers=[0], threads=[1], n_batches=2, n_warmup=1, verbose=False)
+    assert res['batch_size'] in (8, 16) and len(res['trials']) >= 2
+    assert_same_state(before, training_state(learn, cbs))
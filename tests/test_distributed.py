@@ -0,0 +1,34 @@
+import json
+
+import pytest
+import torch
+from torch import nn
+from torcheval.metrics import MulticlassAccuracy
+
+from AIFramework import TrainLearner
+from AIFramework.callbacks import DistributedCB, MetricsCB, launch
+from conftest import synthetic_dls
+
+
+def validate(*callbacks):
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(8, 16), nn.BatchNorm1d(16), nn.ReLU(), nn.Linear(16, 3))
+    # 50 samples, the processes get a different number of batches
+    metrics = MetricsCB(accuracy=MulticlassAccuracy())
+    learn = TrainLearner(model, synthetic_dls(n=50, batch_size=16), callbacks=[*callbacks, metrics])
+    learn.fit(1, train=False)
+    return metrics.values
+
+
+def _validate_worker(rank, world_size, path):
+    values = validate(DistributedCB())
+    if rank == 0:
+        with open(path, 'w') as f:
+            json.dump(values, f)
+
+
+@pytest.mark.parametrize('nprocs', [2, 3])
+def test_distributed_validation_matches_one_process(nprocs, tmp_path):
+    path = tmp_path / 'values.json'
+    launch(_validate_worker, nprocs=nprocs, args=(str(path),))
+    assert json.loads(path.read_text()) == pytest.approx(validate())
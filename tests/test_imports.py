@@ -0,0 +1,29 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from AIFramework.benchmarks import _HEAVY_MODULES
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loaded_after(code):
+    ''' heavy modules in sys.modules after running code in a fresh interpreter '''
+    check = f'; import sys, json; print(json.dumps(sorted({{m.split(".")[0] for m in sys.modules}} & set({list(_HEAVY_MODULES)}))))'
+    out = subprocess.run([sys.executable, '-c', code + check], capture_output=True, text=True, check=True, cwd=ROOT).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+@pytest.mark.parametrize('code', ['import AIFramework',
+                                  'import AIFramework.callbacks',
+                                  'from AIFramework import *',
+                                  'from AIFramework.callbacks import *'])
+def test_heavy_modules_are_not_imported(code):
+    assert loaded_after(code) == []
+
+
+def test_lazy_names_are_importable():
+    assert loaded_after('from AIFramework.callbacks import MulticlassAccuracy') == ['torcheval']
@@ -0,0 +1,23 @@
+import pytest
+import torch
+
+from AIFramework.quantization import quantize, validate_on_cpu
+from conftest import assert_same_state, training_state
+
+
+def test_validate_on_cpu_matches_the_learner(trained):
+    learn, cbs = trained
+    before = training_state(learn, cbs)
+    values = validate_on_cpu(learn, learn.model)
+    assert_same_state(before, training_state(learn, cbs))
+    learn.fit(1, train=False)
+    assert values == pytest.approx(dict(learn.metrics.values))
+
+
+@pytest.mark.skipif(not torch.backends.quantized.supported_engines, reason='no quantized engine')
+def test_quantize_leaves_the_training_state(trained):
+    learn, cbs = trained
+    before = training_state(learn, cbs)
+    res = quantize(learn, mode='dynamic', batch_sizes=None, verbose=False)
+    assert set(res['delta']) == {'accuracy', 'loss'}
+    assert_same_state(before, training_state(learn, cbs))